@@ -0,0 +1,467 @@
+"""
+Reading and writing the data model output.
+"""
+
+from functools import lru_cache
+from typing import Optional
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic_extra_types.coordinate import Latitude, Longitude
+import enums as e
+import data_model as dm
+from utils import csv_dtypes, enum_label_lookup, resolve_type
+
+
+OUTPUT_MODELS = (
+    dm.Employee,
+    dm.DepartingPassengerResident,
+    dm.ArrivingPassengerResident,
+    dm.DepartingPassengerVisitor,
+    dm.ArrivingPassengerVisitor,
+)
+"""
+The most specific data model classes; together with their parent classes and the nested `Trip`,
+they cover every variable in `data_model_output.csv`.
+"""
+
+NESTED_SUFFIXES = ("_person", "_trip")
+"""
+Suffixes notebook 01 adds when a `Trip` variable has the same name as a respondent variable.
+"""
+
+EXTRA_OUTPUT_DTYPES = {
+    "unique_id": "Int64",
+    "is_valid_record": "boolean",
+}
+"""
+Dtypes of the variables added to the output that are not part of the data model.
+"""
+
+
+@lru_cache(maxsize=None)
+def output_field_types(model) -> dict:
+    """
+    Returns the type annotation of each column the model contributes to the flattened data model
+    output: its own, inherited, and computed fields, plus the fields of nested models. A nested
+    field with the same name as a field of `model` is returned twice, with the `_person` and
+    `_trip` suffixes.
+    """
+    field_types = {name: info.annotation for name, info in model.model_fields.items()}
+    field_types.update({name: info.return_type for name, info in model.model_computed_fields.items()})
+
+    nested_models = {}
+    nested_types = {}
+    for name, field_type in field_types.items():
+        base_type = resolve_type(field_type).base_type
+        if isinstance(base_type, type) and issubclass(base_type, dm.BaseModel) and base_type is not model:
+            nested_models[name] = base_type
+            for nested_name, nested_type in output_field_types(base_type).items():
+                nested_types.setdefault(nested_name, nested_type)
+
+    flat_types = {}
+    for name, field_type in field_types.items():
+        if name in nested_models:
+            continue
+        if name in nested_types:
+            flat_types[name + NESTED_SUFFIXES[0]] = field_type
+        else:
+            flat_types[name] = field_type
+
+    for name, field_type in nested_types.items():
+        if name in field_types:
+            flat_types[name + NESTED_SUFFIXES[1]] = field_type
+        else:
+            flat_types[name] = field_type
+
+    return flat_types
+
+
+def column_dtype(name: str, field_type) -> Optional[object]:
+    """
+    Returns the pandas dtype used to read a data model variable, or None to let pandas infer it.
+    Integer Enums are read as the smallest nullable integer type, flags as nullable booleans,
+    coordinates as float32 and other numbers as Int64/float64. Strings and dates are inferred.
+    """
+    type_info = resolve_type(field_type)
+    base_type = type_info.base_type
+    if type_info.is_int_enum:
+        return type_info.storage_dtype.name.capitalize()
+    if type_info.is_enum or not isinstance(base_type, type):
+        return None
+    if issubclass(base_type, bool):
+        return "boolean"
+    if issubclass(base_type, (Latitude, Longitude)) or name.endswith(("_latitude", "_longitude")):
+        return "float32"
+    if issubclass(base_type, int):
+        return "Int64"
+    if issubclass(base_type, float):
+        return "float64"
+    return None
+
+
+def data_model_output_dtypes(models: tuple = OUTPUT_MODELS) -> dict:
+    """
+    Builds the dtype map for `data_model_output.csv` from the data model. Each Enum variable also
+    gets a categorical dtype for its `_label` column, with the Enum members as categories.
+
+    Args:
+        models (tuple): Data model classes whose variables are in the output.
+
+    Returns:
+        dict: Column name to dtype, for use with `pd.read_csv(..., dtype=...)`.
+    """
+    dtypes = dict(EXTRA_OUTPUT_DTYPES)
+    for model in models:
+        for name, field_type in output_field_types(model).items():
+            if name in dtypes:
+                continue
+            dtype = column_dtype(name, field_type)
+            if dtype is not None:
+                dtypes[name] = dtype
+            type_info = resolve_type(field_type)
+            if type_info.is_enum:
+                dtypes.setdefault(f"{name}_label", enum_label_lookup(type_info.base_type).dtype)
+    return dtypes
+
+
+BOOLEAN_STRINGS = {"True": True, "true": True, "1": True, "1.0": True, "False": False, "false": False, "0": False, "0.0": False}
+"""
+How flags are written to csv files, as True/False by pandas or as 1/0 for some synthetic records.
+"""
+
+
+def categorical_to_boolean(values: pd.Series) -> pd.Series:
+    """
+    Converts a categorical column of flag strings (see `BOOLEAN_STRINGS`) to a nullable boolean
+    column using the category codes, without converting each value.
+    """
+    categories = [str(category) for category in values.cat.categories]
+    unknown = [category for category in categories if category not in BOOLEAN_STRINGS]
+    if unknown:
+        raise ValueError(f"values {unknown} are not flags")
+    truth = np.array([BOOLEAN_STRINGS[category] for category in categories] + [False])
+    codes = values.cat.codes.to_numpy()
+    return pd.Series(pd.arrays.BooleanArray(truth[codes], codes == -1), index=values.index)
+
+
+def apply_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """
+    Casts the columns of `df` to the planned dtypes, one column at a time. Columns whose values
+    do not fit the planned dtype are left as they are, with a warning.
+    """
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        try:
+            if dtype == "boolean" and isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = categorical_to_boolean(df[col])
+            elif isinstance(dtype, pd.CategoricalDtype) or df[col].dtype == object:
+                df[col] = df[col].astype(dtype)
+            else:
+                df[col] = pd.to_numeric(df[col]).astype(dtype)
+        except (TypeError, ValueError) as err:
+            warnings.warn(f"Column '{col}' was not converted to {dtype}: {err}")
+    return df
+
+
+def parser_dtypes(dtypes: dict) -> dict:
+    """
+    Returns the dtypes to pass to `pd.read_csv` for a dtype plan. The csv parser is much slower
+    with nullable dtypes, so nullable integers are parsed as floats and flags as categories, to
+    be converted by `apply_dtypes`.
+    """
+    read_dtypes = {}
+    for col, dtype in dtypes.items():
+        if isinstance(dtype, str) and dtype.startswith("Int"):
+            read_dtypes[col] = "float64"
+        elif dtype == "boolean":
+            read_dtypes[col] = "category"
+        else:
+            read_dtypes[col] = dtype
+    return read_dtypes
+
+
+def full_precision_dtypes(dtypes: dict) -> dict:
+    """
+    Returns a dtype plan with the float32 coordinates read as float64, for data that is written
+    back out and must keep every digit of the input.
+    """
+    return {col: "float64" if dtype == "float32" else dtype for col, dtype in dtypes.items()}
+
+
+def read_data_model_output(
+    file: str,
+    columns: Optional[list] = None,
+    models: tuple = OUTPUT_MODELS,
+    prefer_parquet: bool = True,
+    full_precision: bool = False,
+    column_plan_file: Optional[str] = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Reads `data_model_output.csv` (or a file derived from it) with the dtypes planned from the data
+    model, reading only `columns` if given. If the csv file has an up-to-date Parquet sibling (see
+    `write_data_model_output`), the Parquet file is read instead.
+
+    Args:
+        file (str): Path to the csv or Parquet file.
+        columns (list, optional): Columns to read. All columns are read by default.
+        models (tuple): Data model classes whose variables are in the file.
+        prefer_parquet (bool): Read the Parquet sibling of a csv file when it is at least as new and
+            no `pd.read_csv` arguments are given.
+        full_precision (bool): Read the coordinates of a csv file as float64 rather than float32
+            (see `full_precision_dtypes`), e.g. to write the data back to csv. The Parquet sibling,
+            which stores float32 coordinates, is not used.
+        column_plan_file (str, optional): Column plan the file was exported with, e.g.
+            `columns_to_keep.csv` for `atc_travel_survey_final_data.csv` (see `export_final_data`),
+            so the planned dtypes follow the renamed columns.
+        **kwargs: Passed on to `pd.read_csv` or `pd.read_parquet`.
+
+    Returns:
+        pd.DataFrame: The typed data.
+    """
+    dtypes = data_model_output_dtypes(models)
+    if column_plan_file is not None:
+        dtypes = exported_dtypes(dtypes, column_plan_file)
+    if columns is not None:
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+    if full_precision:
+        dtypes = full_precision_dtypes(dtypes)
+
+    if file.endswith(".parquet"):
+        return apply_dtypes(pd.read_parquet(file, columns=columns, **kwargs), dtypes)
+
+    parquet_file = parquet_sibling(file)
+    use_parquet = prefer_parquet and not full_precision and not kwargs
+    if use_parquet and os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= os.path.getmtime(file):
+        return apply_dtypes(pd.read_parquet(parquet_file, columns=columns), dtypes)
+
+    read_dtypes = parser_dtypes(dtypes)
+    try:
+        df = pd.read_csv(file, usecols=columns, dtype=read_dtypes, **kwargs)
+    except (TypeError, ValueError):
+        # a column holds values that do not fit the plan, convert the columns one by one instead
+        df = pd.read_csv(file, usecols=columns, **kwargs)
+    return apply_dtypes(df, dtypes)
+
+
+def parquet_sibling(file: str) -> str:
+    """
+    Returns the path of the Parquet file written next to a csv file, e.g.
+    `data_model_output.parquet` for `data_model_output.csv`.
+    """
+    return os.path.splitext(file)[0] + ".parquet"
+
+
+def to_parquet_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns `df` with the object columns that mix strings with other values (e.g. numbers and
+    strings in a free text variable) converted to strings, which Parquet requires.
+    """
+    mixed = [
+        col for col in df.columns[df.dtypes == object]
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ("string", "empty", "boolean", "date", "datetime")
+    ]
+    if not mixed:
+        return df
+    return df.assign(**{col: df[col].astype("string") for col in mixed})
+
+
+def write_data_model_output(
+    df: pd.DataFrame,
+    file: str,
+    write_parquet: bool = True,
+    models: tuple = OUTPUT_MODELS,
+    **kwargs,
+) -> Optional[str]:
+    """
+    Writes the data model output to csv and, by default, a typed, compressed Parquet sibling (see
+    `parquet_sibling`). The Parquet file keeps the planned dtypes, including the categories of the
+    `_label` columns, so downstream notebooks can read only the columns they need with
+    `read_data_model_output(file, columns=[...])`.
+
+    Args:
+        df (pd.DataFrame): The data to write, with `unique_id` as a column.
+        file (str): Path to the csv file.
+        write_parquet (bool): Also write the Parquet sibling.
+        models (tuple): Data model classes whose variables are in the file.
+        **kwargs: Passed on to `pd.DataFrame.to_csv`; `index=False` by default.
+
+    Returns:
+        str: Path of the Parquet file, or None if it was not written.
+    """
+    kwargs.setdefault("index", False)
+    df.to_csv(file, **kwargs)
+    if not write_parquet:
+        return None
+
+    parquet_file = parquet_sibling(file)
+    typed_df = apply_dtypes(df.copy(), data_model_output_dtypes(models))
+    to_parquet_safe(typed_df).to_parquet(parquet_file, index=False, compression="zstd")
+    return parquet_file
+
+
+def attach_weights(
+    df: pd.DataFrame,
+    weights: dict,
+    id_column: str = "unique_id",
+    weight_column: str = "weight",
+    drop_columns: tuple = ("weight",),
+) -> pd.DataFrame:
+    """
+    Attaches expansion weights to the data model output, one column per expansion scenario. The
+    index of `id_column` is built once, each weight file is aligned to it by position, and all
+    weight columns are added to the wide table in a single step rather than one merge per file.
+    Records that are not in a weight file (e.g. invalid records or arriving passengers in a
+    departing only expansion) get a missing weight; weights of records that are not in the data
+    are dropped with a warning.
+
+    Args:
+        df (pd.DataFrame): Data model output.
+        weights (dict): Weight column name to a weights only csv file (or data frame) with the
+            `id_column` and `weight_column` columns, e.g. `survey_weights_only_departing_only.csv`.
+        id_column (str): Column identifying the records.
+        weight_column (str): Column holding the weight in the weight files.
+        drop_columns (tuple): Columns of `df` to remove, e.g. the unexpanded weight. Existing
+            columns with the names of the new weight columns are always replaced.
+
+    Returns:
+        pd.DataFrame: `df` with the weight columns added at the end.
+    """
+    ids = pd.Index(df[id_column])
+    if not ids.is_unique:
+        raise ValueError(f"'{id_column}' is not unique in the data")
+
+    weight_columns = {}
+    for col, weights_df in weights.items():
+        if isinstance(weights_df, str):
+            weights_df = pd.read_csv(weights_df, usecols=[id_column, weight_column])
+        if weights_df[id_column].duplicated().any():
+            raise ValueError(f"'{id_column}' is not unique in the weights for '{col}'")
+
+        positions = ids.get_indexer(weights_df[id_column])
+        found = positions >= 0
+        if not found.all():
+            warnings.warn(f"{col}: {(~found).sum()} {id_column} values of the weights are not in the data and were ignored")
+
+        values = np.full(len(df), np.nan)
+        values[positions[found]] = weights_df[weight_column].to_numpy(dtype=float)[found]
+        weight_columns[col] = values
+        print(f"{col}: {found.sum()} of {len(df)} records weighted")
+
+    replaced = [col for col in list(drop_columns) + list(weight_columns) if col in df.columns]
+    return pd.concat([df.drop(columns=replaced), pd.DataFrame(weight_columns, index=df.index)], axis=1)
+
+
+def read_column_plan(file: str) -> tuple:
+    """
+    Reads a column plan such as `columns_to_keep.csv`, with a `column` and a `status` column. The
+    status is `keep`, `delete`, or the new name of the column.
+
+    Returns:
+        tuple: The set of columns to delete and a dict of the columns to rename.
+    """
+    plan = pd.read_csv(file, dtype=str)
+    status = dict(zip(plan["column"], plan["status"]))
+    delete = {col for col, new_name in status.items() if new_name == "delete"}
+    rename = {col: new_name for col, new_name in status.items() if new_name not in ("keep", "delete")}
+    return delete, rename
+
+
+def exported_dtypes(dtypes: dict, column_plan_file: str) -> dict:
+    """
+    Returns the dtype plan of a file written by `export_final_data`: the deleted columns are
+    left out and the renamed columns take the dtypes of the columns they were renamed from, e.g.
+    `main_mode_label` the categories of `main_mode_grouped_label`.
+    """
+    delete, rename = read_column_plan(column_plan_file)
+    exported = {col: dtype for col, dtype in dtypes.items() if col not in delete and col not in rename}
+    exported.update({new_name: dtypes[col] for col, new_name in rename.items() if col in dtypes})
+    return exported
+
+
+def export_final_data(
+    input_file: str,
+    output_file: str,
+    column_plan_file: str,
+    filter_column: str = "is_valid_record",
+    chunksize: int = 50000,
+    write_parquet: bool = True,
+    models: tuple = OUTPUT_MODELS,
+) -> int:
+    """
+    Writes the final survey deliverable from the data model output: the records with a true
+    `filter_column`, with the columns deleted and renamed per the column plan (see
+    `read_column_plan`). Columns missing from the plan are kept. Only the kept columns are read,
+    and the rows are filtered and written one chunk at a time, so memory does not depend on the
+    size of the input. The output is typed per the data model (see `data_model_output_dtypes`)
+    and, by default, also written to a Parquet sibling of `output_file`.
+
+    Columns that are not in the data model get a single dtype for the whole file (see
+    `utils.csv_dtypes`), with text as `string`, so every chunk is formatted and stored alike. The
+    files are written under a temporary name and only replace `output_file` and its Parquet
+    sibling once every chunk has been written.
+
+    Args:
+        input_file (str): Path to `data_model_output.csv`.
+        output_file (str): Path of the csv file to write, e.g. `atc_travel_survey_final_data.csv`.
+        column_plan_file (str): Path to the column plan, e.g. `columns_to_keep.csv`.
+        filter_column (str): Flag column selecting the records to keep. It is read even when the
+            plan deletes it.
+        chunksize (int): Number of input rows read at a time.
+        write_parquet (bool): Also write the Parquet sibling.
+        models (tuple): Data model classes whose variables are in the file.
+
+    Returns:
+        int: The number of records written.
+    """
+    delete, rename = read_column_plan(column_plan_file)
+    header = pd.read_csv(input_file, nrows=0).columns
+    keep = [col for col in header if col not in delete]
+    usecols = keep if filter_column in keep else keep + [filter_column]
+
+    # coordinates keep their full precision in the deliverable
+    dtypes = full_precision_dtypes({col: dtype for col, dtype in data_model_output_dtypes(models).items() if col in usecols})
+    unplanned = [col for col in usecols if col not in dtypes]
+    if unplanned:
+        found = csv_dtypes(input_file, chunksize=chunksize, usecols=unplanned)
+        dtypes.update({col: "string" if found[col] == "object" else found[col] for col in unplanned})
+
+    # the header and the Parquet schema come from the plan rather than the first chunk
+    empty = pd.DataFrame({col: pd.Series(dtype=dtypes[col]) for col in keep}).rename(columns=rename)
+    parquet_file = parquet_sibling(output_file)
+    temp_file, temp_parquet_file = f"{output_file}.tmp", f"{parquet_file}.tmp"
+    empty.to_csv(temp_file, index=False)
+    writer = None
+    num_records = 0
+    try:
+        if write_parquet:
+            schema = pa.Schema.from_pandas(empty, preserve_index=False)
+            writer = pq.ParquetWriter(temp_parquet_file, schema, compression="zstd")
+        for chunk in pd.read_csv(input_file, usecols=usecols, dtype=parser_dtypes(dtypes), chunksize=chunksize):
+            chunk = apply_dtypes(chunk, dtypes)
+            chunk = chunk.loc[chunk[filter_column].fillna(False).astype(bool), keep].rename(columns=rename)
+            chunk.to_csv(temp_file, mode="a", header=False, index=False)
+            if writer is not None:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            num_records += len(chunk)
+        if writer is not None:
+            writer.close()
+            writer = None
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        for file in (temp_file, temp_parquet_file):
+            if os.path.exists(file):
+                os.remove(file)
+        raise
+
+    os.replace(temp_file, output_file)
+    if write_parquet:
+        os.replace(temp_parquet_file, parquet_file)
+    return num_records
@@ -0,0 +1,1251 @@
+"""
+Survey expansion: fits the survey weights to the expansion controls.
+
+This is a Python version of `notebooks/02-survey-expansion.Rmd`. It reads the same
+`expansion_config_*.yaml`, controls and control expressions files and writes the same
+`survey_weights_only_*`, `rfac_all_*` and `convergence_stat_*` files.
+"""
+
+import copy
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import yaml
+from scipy import sparse
+from expressions import ControlExpression
+
+
+STAT_COLUMNS = [
+    "iter", "control", "mean_adj", "min_adj", "max_adj", "std_adj",
+    "mean_weight", "min_weight", "max_weight", "sd_weight",
+]
+"""
+Columns of the `convergence_stat_*.csv` files.
+"""
+
+CONVERGENCE_COLUMNS = ["iter", "max_control_gap", "max_weight_change", "converged"]
+"""
+Columns of the convergence assessment of each iteration, see `SurveyExpansion.run`.
+"""
+
+METHODS = ("sequential", "simultaneous")
+"""
+Fitting methods of the expansion, see `SurveyExpansion.run`.
+"""
+
+TRACE_LEVELS = ("control", "iteration")
+"""
+Granularity of the convergence statistics, see `ConvergenceTrace`.
+"""
+
+REPLICATE_METHODS = ("bootstrap", "jackknife")
+"""
+Methods of drawing replicate weights, see `replicate_multipliers`.
+"""
+
+REPLICATE_STRATA = ["airport_terminal", "marketsegment", "is_self_administered"]
+"""
+Default strata of the replicate weights: terminal, market segment and self-administered
+versus intercept records.
+"""
+
+COUNT_COLUMN = "count"
+"""
+Survey column equal to 1 for every record, the index key of the controls on the `ALL` row.
+"""
+
+
+class ExpansionConfig:
+    """
+    Settings of one expansion, as in the `expansion_config_*.yaml` files.
+    """
+
+    def __init__(
+        self,
+        survey_file: str,
+        controls_file: str,
+        config_file: str,
+        survey_expanded_file: Optional[str] = None,
+        stat_file: Optional[str] = None,
+        rfac_file: Optional[str] = None,
+        weights_only_file: Optional[str] = None,
+        replicate_weights_file: Optional[str] = None,
+        warm_start_weights_file: Optional[str] = None,
+        warm_start_rfac_file: Optional[str] = None,
+        max_iteration: int = 50,
+        scaling_factor_low: float = 100,
+        scaling_factor_high: float = 100,
+        departing_only: bool = False,
+        non_sas_only: bool = False,
+        control_tolerance: Optional[float] = None,
+        weight_tolerance: Optional[float] = None,
+        method: str = "sequential",
+        trace: str = "control",
+        name: Optional[str] = None,
+    ):
+        """
+        Args:
+            survey_file (str): Path to the survey data, e.g. `data_model_output.csv`.
+            controls_file (str): Path to the controls, e.g. `expansion_controls_departing_only.csv`.
+            config_file (str): Path to the control expressions, e.g.
+                `expansion_controls_expressions_departing_only.csv`.
+            survey_expanded_file (str, optional): Path of the expanded survey to write.
+            stat_file (str, optional): Path of the convergence statistics to write.
+            rfac_file (str, optional): Path of the relaxation factors to write.
+            weights_only_file (str, optional): Path of the `unique_id`, `weight` file to write.
+            replicate_weights_file (str, optional): Path of the replicate weights to write, see
+                `run_replicates`.
+            warm_start_weights_file (str, optional): Path of the weights of a previous run, e.g. a
+                `survey_weights_only_*.csv` file, to start from. See `SurveyExpansion.seed_weights`;
+                the `simultaneous` method starts from the relaxation factors only.
+            warm_start_rfac_file (str, optional): Path of the relaxation factors of a previous
+                run, e.g. a `rfac_all_*.csv` file, to start from. See `SurveyExpansion.seed_rfac`.
+            max_iteration (int): Maximum number of passes over the controls.
+            scaling_factor_low (float): The minimum weight is the average weight of the market
+                segment divided by this factor.
+            scaling_factor_high (float): The maximum weight is the average weight of the market
+                segment multiplied by this factor.
+            departing_only (bool): Expand departing passengers and employees only.
+            non_sas_only (bool): Leave out the self-administered survey records.
+            control_tolerance (float, optional): Stop when the largest relative gap between a
+                control and its target is at most this value. See `SurveyExpansion.run`.
+            weight_tolerance (float, optional): Stop when the largest relative change of a weight
+                over an iteration is at most this value. See `SurveyExpansion.run`.
+            method (str): `sequential` to fit one control at a time, as in the R notebook, or
+                `simultaneous` to fit all the controls jointly. See `SurveyExpansion.run`.
+            trace (str): `control` for a row of convergence statistics per control and pass, as
+                in the R notebook, or `iteration` for a row per pass. See `ConvergenceTrace`.
+            name (str, optional): Name of the expansion, e.g. `departing_only`.
+        """
+        self.survey_file = survey_file
+        self.controls_file = controls_file
+        self.config_file = config_file
+        self.survey_expanded_file = survey_expanded_file
+        self.stat_file = stat_file
+        self.rfac_file = rfac_file
+        self.weights_only_file = weights_only_file
+        self.replicate_weights_file = replicate_weights_file
+        self.warm_start_weights_file = warm_start_weights_file
+        self.warm_start_rfac_file = warm_start_rfac_file
+        self.max_iteration = max_iteration
+        self.scaling_factor_low = scaling_factor_low
+        self.scaling_factor_high = scaling_factor_high
+        self.departing_only = departing_only
+        self.non_sas_only = non_sas_only
+        self.control_tolerance = control_tolerance
+        self.weight_tolerance = weight_tolerance
+        self.method = method
+        self.trace = trace
+        self.name = name
+
+    @classmethod
+    def from_yaml(cls, file: str, processed_dir: Optional[str] = None, interim_dir: Optional[str] = None):
+        """
+        Reads an `expansion_config_*.yaml` file. As in the R notebook, the survey file is in the
+        processed folder and the other input and output files are in the interim folder. The
+        optional `warm_start_weights_file` and `warm_start_rfac_file` inputs name the output files
+        of a previous run to start from.
+
+        Args:
+            file (str): Path to the configuration file.
+            processed_dir (str, optional): Folder of the survey file. Defaults to the `processed`
+                folder next to the folder of the configuration file.
+            interim_dir (str, optional): Folder of the other files. Defaults to the folder of the
+                configuration file.
+        """
+        if interim_dir is None:
+            interim_dir = os.path.dirname(os.path.abspath(file))
+        if processed_dir is None:
+            processed_dir = os.path.join(os.path.dirname(interim_dir), "processed")
+
+        with open(file) as f:
+            script_config = yaml.safe_load(f)
+        inputs = script_config["input"]
+        outputs = script_config.get("output") or {}
+        parameters = script_config.get("parameters") or {}
+        name = os.path.splitext(os.path.basename(file))[0].replace("expansion_config_", "")
+
+        def interim_path(key, files=outputs):
+            return os.path.join(interim_dir, files[key]) if files.get(key) else None
+
+        return cls(
+            survey_file=os.path.join(processed_dir, inputs["survey_file"]),
+            controls_file=os.path.join(interim_dir, inputs["controls_file"]),
+            config_file=os.path.join(interim_dir, inputs["config_file"]),
+            survey_expanded_file=interim_path("survey_expanded_file"),
+            stat_file=interim_path("stat_file"),
+            rfac_file=interim_path("rfac_file"),
+            weights_only_file=interim_path("weights_only_file"),
+            replicate_weights_file=interim_path("replicate_weights_file"),
+            warm_start_weights_file=interim_path("warm_start_weights_file", inputs),
+            warm_start_rfac_file=interim_path("warm_start_rfac_file", inputs),
+            name=name,
+            **parameters,
+        )
+
+
+def evaluate_expression(df: pd.DataFrame, expression) -> np.ndarray:
+    """
+    Evaluates a control expression written in R, such as
+    `ifelse(inbound_or_outbound==1 & main_mode %in% c(15), party_size_flight, 0)`, over the survey
+    columns. See `expressions.ControlExpression` for the accepted syntax.
+
+    Args:
+        df (pd.DataFrame): The survey records.
+        expression (str | ControlExpression): The expression, as text or already compiled.
+    """
+    if not isinstance(expression, ControlExpression):
+        expression = ControlExpression(expression)
+    return expression.evaluate(df)
+
+
+def evaluate_incidence(df: pd.DataFrame, expressions: list) -> sparse.csc_array:
+    """
+    Evaluates control expressions into a sparse matrix with a row per record and a column per
+    expression, storing only the non-zero values.
+    """
+    rows, values = [], []
+    for expression in expressions:
+        x = evaluate_expression(df, expression)
+        nonzero = np.flatnonzero(x)
+        rows.append(nonzero)
+        values.append(x[nonzero])
+    indptr = np.concatenate([[0], np.cumsum([len(nonzero) for nonzero in rows])]).astype(np.int64)
+    return sparse.csc_array(
+        (
+            np.concatenate(values) if values else np.zeros(0),
+            np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64),
+            indptr,
+        ),
+        shape=(len(df), len(expressions)),
+    )
+
+
+def key_columns(key: str) -> list:
+    """
+    Returns the columns of an index key or control key, e.g. `["airport_terminal",
+    "marketsegment"]` for `airport_terminal+marketsegment`.
+    """
+    return [column.strip() for column in key.split("+")]
+
+
+def read_control_config(file: str) -> pd.DataFrame:
+    """
+    Reads the control expressions, e.g. `expansion_controls_expressions_departing_only.csv`,
+    keeping the controls with `use` equal to 1.
+    """
+    config_df = pd.read_csv(file, dtype={"controlid": str, "expression": str, "indexkey": str, "controlkey": str})
+    return config_df[config_df["use"] == 1].reset_index(drop=True)
+
+
+def read_controls(file: str) -> pd.DataFrame:
+    """
+    Reads the controls, e.g. `expansion_controls_departing_only.csv`, with missing targets as 0.
+    """
+    controls_df = pd.read_csv(file, dtype={"airport_terminal": str})
+    return controls_df.fillna(0)
+
+
+def prepare_survey(
+    survey_df: pd.DataFrame,
+    departing_only: bool = False,
+    non_sas_only: bool = False,
+) -> pd.DataFrame:
+    """
+    Selects the records to expand: valid records, departing only and not self-administered if
+    asked. As in the R notebook, missing values are set to 0, `airport_terminal` is made a
+    string to match the controls, and a `count` column of 1s is added.
+    """
+    survey_df = survey_df[survey_df["is_valid_record"].astype(str) == "True"]
+    survey_df = survey_df.fillna(0).reset_index(drop=True)
+    survey_df["airport_terminal"] = survey_df["airport_terminal"].astype(float).astype(int).astype(str)
+    survey_df[COUNT_COLUMN] = 1
+
+    selected = scenario_rows(survey_df, departing_only, non_sas_only)
+    if selected.all():
+        return survey_df
+    return survey_df[selected].reset_index(drop=True)
+
+
+def scenario_rows(survey_df: pd.DataFrame, departing_only: bool = False, non_sas_only: bool = False) -> np.ndarray:
+    """
+    Returns which of the valid records (see `prepare_survey`) an expansion uses.
+    """
+    selected = np.ones(len(survey_df), dtype=bool)
+    if departing_only:
+        selected &= (survey_df["inbound_or_outbound"] == 1).to_numpy()
+    if non_sas_only:
+        selected &= (survey_df["is_self_administered"].astype(str) == "False").to_numpy()
+    return selected
+
+
+class ConvergenceTrace:
+    """
+    Convergence statistics of an expansion run, in the layout of the `convergence_stat_*.csv`
+    files (`STAT_COLUMNS`).
+
+    The statistics are written into an array allocated for the largest possible run. The sum,
+    sum of squares, minimum and maximum of the weights are accumulated from the records each
+    update changes, instead of being recomputed over all the records, and are recomputed
+    exactly once per pass. With the `control` granularity there is a row per control and pass,
+    as in the R notebook. With `iteration` there is a row per pass, with control `all`, whose
+    correction statistics pool the corrections of all the controls.
+    """
+
+    def __init__(self, controls: list, max_iteration: int, weight: np.ndarray, granularity: str = "control"):
+        """
+        Args:
+            controls (list): Names of the controls.
+            max_iteration (int): Maximum number of passes.
+            weight (np.ndarray): The starting weights.
+            granularity (str): `control` or `iteration`.
+        """
+        if granularity not in TRACE_LEVELS:
+            raise ValueError(f"Unknown trace granularity '{granularity}', expected one of {TRACE_LEVELS}")
+        self.controls = controls
+        self.granularity = granularity
+        rows = max_iteration * len(controls) if granularity == "control" else max_iteration
+        self.values = np.full((rows, len(STAT_COLUMNS) - 2), np.nan)
+        self.iterations = np.zeros(rows, dtype=np.int64)
+        self.control_index = np.full(rows, -1, dtype=np.int64)
+        self.num_rows = 0
+        self.reset_weights(weight)
+        self.reset_corrections()
+
+    def reset_weights(self, weight: np.ndarray):
+        """
+        Recomputes the weight accumulators over all the records.
+        """
+        self.num_weights = len(weight)
+        self.weight_sum = weight.sum()
+        self.weight_sum_sq = np.dot(weight, weight)
+        self.weight_min = weight.min() if len(weight) else np.nan
+        self.weight_max = weight.max() if len(weight) else np.nan
+
+    def update_weights(self, weight: np.ndarray, rows: np.ndarray, previous: np.ndarray):
+        """
+        Updates the weight accumulators after the weights of `rows` changed from `previous`.
+        The minimum or maximum is recomputed only when the record holding it changed.
+        """
+        if len(rows) == 0:
+            return
+        current = weight[rows]
+        self.weight_sum += current.sum() - previous.sum()
+        self.weight_sum_sq += np.dot(current, current) - np.dot(previous, previous)
+        if previous.min() <= self.weight_min:
+            self.weight_min = weight.min()
+        else:
+            self.weight_min = min(self.weight_min, current.min())
+        if previous.max() >= self.weight_max:
+            self.weight_max = weight.max()
+        else:
+            self.weight_max = max(self.weight_max, current.max())
+
+    def reset_corrections(self):
+        """
+        Resets the accumulators of the corrections pooled over a pass.
+        """
+        self.correction_count = 0
+        self.correction_sum = 0.0
+        self.correction_sum_sq = 0.0
+        self.correction_min = np.inf
+        self.correction_max = -np.inf
+
+    @staticmethod
+    def summary(
+        count: int, total: float, total_sq: float, minimum: float, maximum: float, shift: float = 0.0
+    ) -> list:
+        """
+        Returns the mean, minimum, maximum and standard deviation (`ddof=1`) of accumulated values.
+        The sums may be of the values minus `shift`, which keeps the variance accurate when the
+        values are close to `shift` (e.g. corrections close to 1).
+        """
+        if count == 0:
+            return [np.nan] * 4
+        variance = max(total_sq - total * total / count, 0.0) / (count - 1) if count > 1 else np.nan
+        return [total / count + shift, minimum, maximum, np.sqrt(variance)]
+
+    def add(self, iteration: int, j: int, correction: np.ndarray):
+        """
+        Records the corrections of control `j` in a pass, with the current weights.
+        """
+        valid = correction[~np.isnan(correction)]
+        deviation = valid - 1
+        if self.granularity == "iteration":
+            if len(valid):
+                self.correction_count += len(valid)
+                self.correction_sum += deviation.sum()
+                self.correction_sum_sq += np.dot(deviation, deviation)
+                self.correction_min = min(self.correction_min, valid.min())
+                self.correction_max = max(self.correction_max, valid.max())
+            return
+        self.write_row(iteration, j, self.summary(
+            len(valid), deviation.sum(), np.dot(deviation, deviation),
+            valid.min() if len(valid) else np.nan, valid.max() if len(valid) else np.nan, shift=1.0,
+        ))
+
+    def end_iteration(self, iteration: int, weight: np.ndarray):
+        """
+        Closes a pass: writes its row with the `iteration` granularity and recomputes the weight
+        accumulators exactly.
+        """
+        if self.granularity == "iteration":
+            self.write_row(iteration, -1, self.summary(
+                self.correction_count, self.correction_sum, self.correction_sum_sq,
+                self.correction_min, self.correction_max, shift=1.0,
+            ))
+            self.reset_corrections()
+        self.reset_weights(weight)
+
+    def write_row(self, iteration: int, j: int, correction_stats: list):
+        """
+        Writes a row of statistics, with the current weight statistics.
+        """
+        row = self.num_rows
+        self.iterations[row] = iteration
+        self.control_index[row] = j
+        self.values[row] = correction_stats + self.summary(
+            self.num_weights, self.weight_sum, self.weight_sum_sq, self.weight_min, self.weight_max
+        )
+        self.num_rows += 1
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Returns the statistics recorded so far, see `STAT_COLUMNS`.
+        """
+        labels = np.array(list(self.controls) + ["all"], dtype=object)
+        stats_df = pd.DataFrame(self.values[:self.num_rows], columns=STAT_COLUMNS[2:])
+        stats_df.insert(0, "control", labels[self.control_index[:self.num_rows]])
+        stats_df.insert(0, "iter", self.iterations[:self.num_rows])
+        return stats_df
+
+
+class SurveyExpansion:
+    """
+    Newton-Raphson fit of the survey weights to the controls, one control at a time.
+
+    For each control, the incidence of the records (the value of the control expression, e.g.
+    the party size of departing passengers) is stored in a column of a sparse matrix, so memory
+    and the cost of an update grow with the number of incident records rather than with the
+    number of records times controls. The records are linked to the rows of the controls table
+    by integer group codes, computed once from the index key (e.g. `airport_terminal`) and the
+    control key. The weighted sums of each group are computed with `np.bincount` and the
+    corrections are broadcast back to the records by indexing, so the survey is never joined to
+    the controls. Records whose index key matches
+    no row of the controls table keep their weight (in R, their weight becomes missing).
+    """
+
+    def __init__(
+        self,
+        survey_df: pd.DataFrame,
+        controls_df: pd.DataFrame,
+        config_df: pd.DataFrame,
+        scaling_factor_low: float = 100,
+        scaling_factor_high: float = 100,
+        id_column: str = "unique_id",
+        incidence: Optional[sparse.sparray] = None,
+    ):
+        """
+        Args:
+            survey_df (pd.DataFrame): Records to expand, see `prepare_survey`.
+            controls_df (pd.DataFrame): Controls, see `read_controls`.
+            config_df (pd.DataFrame): Control expressions, see `read_control_config`.
+            scaling_factor_low (float): See `ExpansionConfig`.
+            scaling_factor_high (float): See `ExpansionConfig`.
+            id_column (str): Column identifying the records.
+            incidence (sparse.sparray, optional): The values of the control expressions, records
+                by controls, when they are already evaluated (see `run_expansions`). By default,
+                the expressions are evaluated over `survey_df`.
+        """
+        self.survey_df = survey_df
+        self.controls_df = controls_df
+        self.config_df = config_df
+        self.ids = survey_df[id_column].to_numpy()
+        self.id_column = id_column
+
+        self.controls = config_df["controlid"].tolist()
+        missing = [control for control in self.controls if control not in controls_df.columns]
+        if missing:
+            raise ValueError(f"Controls not found in the controls file: {missing}")
+        self.priority = config_df["priority"].to_numpy(dtype=float)
+        self.control_keys = config_df["controlkey"].tolist()
+        self.expressions = [ControlExpression(expression) for expression in config_df["expression"]]
+
+        self.targets = controls_df[self.controls].to_numpy(dtype=float)
+        self.build_incidence(incidence)
+
+        self.initial_weight = (
+            survey_df["weight"].to_numpy(dtype=float) if "weight" in survey_df.columns else np.ones(len(survey_df))
+        )
+        self.min_weight, self.max_weight = self.weight_bounds(scaling_factor_low, scaling_factor_high)
+
+    def build_incidence(self, incidence: Optional[sparse.sparray] = None):
+        """
+        Evaluates the control expressions into a sparse incidence matrix, with a row per record
+        and a column per control, unless the values are given in `incidence`. Only the non-zero
+        values are stored, with the group code (see `group_code`) of each value in
+        `entry_codes`, aligned with the column-major (CSC) copy of the matrix that the
+        per-control updates read.
+        """
+        if incidence is None:
+            incidence = evaluate_incidence(self.survey_df, self.expressions)
+        incidence = sparse.csc_array(incidence, dtype=float, copy=True)
+        if incidence.shape != (len(self.survey_df), len(self.controls)):
+            raise ValueError(f"Incidence of shape {incidence.shape} does not match the records and controls")
+        incidence.eliminate_zeros()
+        incidence.sort_indices()
+        self.incidence_by_control = incidence
+
+        num_groups = len(self.controls_df)
+        codes = []
+        self.has_records = np.zeros((num_groups, len(self.controls)), dtype=bool)
+        for j, row in self.config_df.iterrows():
+            group_codes = self.group_code(row["indexkey"], row["controlkey"])
+            self.has_records[:, j] = np.bincount(group_codes[group_codes >= 0], minlength=num_groups) > 0
+            codes.append(group_codes[incidence.indices[incidence.indptr[j]:incidence.indptr[j + 1]]])
+        self.entry_codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.intp)
+        self.incidence = self.incidence_by_control.tocsr()
+
+        # one row per (controls table row, control) pair, so all the control sums are one product
+        matched = self.entry_codes >= 0
+        control_index = np.repeat(np.arange(len(self.controls)), np.diff(incidence.indptr))
+        self.grouped_incidence = sparse.csr_array(
+            (
+                self.incidence_by_control.data[matched],
+                (self.entry_codes[matched] * len(self.controls) + control_index[matched],
+                 self.incidence_by_control.indices[matched]),
+            ),
+            shape=(num_groups * len(self.controls), len(self.survey_df)),
+        )
+        # the control rows the expansion fits: a positive target, records in the group, and
+        # records that contribute to the control
+        contributing = (self.grouped_incidence @ np.ones(len(self.survey_df))).reshape(self.targets.shape) > 0
+        self.fitted = (self.targets > 0) & self.has_records & contributing
+
+    def control_entries(self, j: int) -> tuple:
+        """
+        Returns the records with a non-zero incidence for control `j`, their incidence values and
+        their group codes.
+        """
+        start, end = self.incidence_by_control.indptr[j], self.incidence_by_control.indptr[j + 1]
+        return (
+            self.incidence_by_control.indices[start:end],
+            self.incidence_by_control.data[start:end],
+            self.entry_codes[start:end],
+        )
+
+    def control_sums(self, weight: np.ndarray) -> np.ndarray:
+        """
+        Returns the weighted sum of each control for each row of the controls table, as a sparse
+        matrix-vector product over the records with a non-zero incidence.
+        """
+        return (self.grouped_incidence @ weight).reshape(self.targets.shape)
+
+    def control_gap(self, weight: np.ndarray, rfac: Optional[np.ndarray] = None) -> float:
+        """
+        Returns the largest relative gap between a control sum and its relaxed target,
+        `target * rfac`, over the control rows the expansion fits (see `fitted`). A target that
+        no record contributes to cannot be met by any weights and is left out, as is the part of a
+        target that a low priority control gives up through its relaxation factor. Without
+        `rfac`, the gaps are to the targets themselves.
+        """
+        if not self.fitted.any():
+            return 0.0
+        target = self.targets if rfac is None else self.targets * rfac
+        sums = self.control_sums(weight)
+        return float(np.max(np.abs(sums[self.fitted] - target[self.fitted]) / target[self.fitted]))
+
+    def group_code(self, index_key: str, control_key: str) -> np.ndarray:
+        """
+        Returns, for each record, the row of the controls table whose `control_key` values equal
+        the record's `index_key` values, or -1 if there is none. Keys of several columns are
+        written with `+`, e.g. `airport_terminal+marketsegment` (see `key_columns`).
+
+        Each key column is factorized once and the codes of the columns are combined into one
+        integer per record and per row of the controls table, so any number of key columns is
+        matched without joining the tables.
+        """
+        index_columns, control_columns = key_columns(index_key), key_columns(control_key)
+        if len(index_columns) != len(control_columns):
+            raise ValueError(f"Index key '{index_key}' and control key '{control_key}' have different numbers of columns")
+
+        record_codes = np.zeros(len(self.survey_df), dtype=np.int64)
+        row_codes = np.zeros(len(self.controls_df), dtype=np.int64)
+        unmatched = np.zeros(len(self.survey_df), dtype=bool)
+        for index_column, control_column in zip(index_columns, control_columns):
+            key_values = self.controls_df[control_column].reset_index(drop=True)
+            record_values = self.survey_df[index_column]
+            if pd.api.types.is_numeric_dtype(key_values) and not pd.api.types.is_numeric_dtype(record_values):
+                record_values = pd.to_numeric(record_values, errors="coerce")
+            elif not pd.api.types.is_numeric_dtype(key_values):
+                record_values = record_values.astype(str)
+            key_codes, uniques = pd.factorize(key_values)
+            codes = pd.Index(uniques).get_indexer(record_values)
+            unmatched |= codes < 0
+            record_codes = record_codes * len(uniques) + codes
+            row_codes = row_codes * len(uniques) + key_codes
+        record_codes[unmatched] = -1
+
+        # repeated key values (e.g. the 0s of the `all` column) may only be left unmatched
+        duplicated = pd.Series(row_codes).duplicated(keep=False).to_numpy()
+        if np.isin(record_codes, row_codes[duplicated]).any():
+            raise ValueError(f"Values of '{index_key}' match more than one row of control key '{control_key}'")
+        unique_rows = np.flatnonzero(~duplicated)
+        positions = pd.Index(row_codes[~duplicated]).get_indexer(record_codes)
+        return np.where((positions >= 0) & ~unmatched, unique_rows[positions], -1)
+
+    def weight_bounds(self, scaling_factor_low: float, scaling_factor_high: float) -> tuple:
+        """
+        Returns the minimum and maximum weight of each record. The average weight of a market
+        segment is the total of the controls (`tot_emp` for employees, `total_pax` otherwise)
+        divided by the sum of the initial weights of the segment.
+        """
+        segments, segment_codes = np.unique(self.survey_df["marketsegment"].to_numpy(), return_inverse=True)
+        segment_weights = np.bincount(segment_codes, weights=self.initial_weight, minlength=len(segments))
+        totals = np.where(
+            segments == 2,
+            self.controls_df["tot_emp"].sum() if "tot_emp" in self.controls_df else np.nan,
+            self.controls_df["total_pax"].sum() if "total_pax" in self.controls_df else np.nan,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            average = totals / segment_weights
+        return (average / scaling_factor_low)[segment_codes], (average * scaling_factor_high)[segment_codes]
+
+    def seed_weights(self, weights_df: pd.DataFrame, weight_column: str = "weight") -> np.ndarray:
+        """
+        Returns starting weights from the weights of a previous run, matched to the records by
+        id. Records that are not in `weights_df` (e.g. late records) keep their initial weight,
+        with a warning, and the weights are kept within the weight bounds.
+        """
+        ids = pd.Index(weights_df[self.id_column])
+        if not ids.is_unique:
+            raise ValueError(f"Duplicate values of '{self.id_column}' in the warm start weights")
+        positions = ids.get_indexer(self.ids)
+        found = positions >= 0
+        if not found.all():
+            warnings.warn(
+                f"{(~found).sum()} of {len(found)} records not found in the warm start weights, "
+                "they start from their initial weight"
+            )
+        weight = self.initial_weight.copy()
+        weight[found] = weights_df[weight_column].to_numpy(dtype=float)[positions[found]]
+        return np.minimum(np.maximum(weight, self.min_weight), self.max_weight)
+
+    def seed_rfac(self, rfac_df: pd.DataFrame) -> np.ndarray:
+        """
+        Returns starting relaxation factors from those of a previous run (see `rfac_frame`),
+        matched to the rows of the controls table by the control key columns. Controls or rows
+        that are not in `rfac_df` start from 1, with a warning for the controls; without the
+        control key columns (e.g. in a file written by the R notebook), all do.
+        """
+        columns = list(dict.fromkeys(column for key in self.control_keys for column in key_columns(key)))
+        missing = [column for column in columns if column not in rfac_df.columns]
+        if missing:
+            warnings.warn(
+                f"Control key columns {missing} not found in the warm start relaxation factors, "
+                "all the relaxation factors start from 1"
+            )
+            return np.ones_like(self.targets)
+        unmatched = [control for control in self.controls if f"R_{control}" not in rfac_df.columns]
+        if unmatched:
+            warnings.warn(f"Controls {unmatched} not found in the warm start relaxation factors, they start from 1")
+
+        def key_frame(df):
+            keys = {}
+            for column in columns:
+                if pd.api.types.is_numeric_dtype(self.controls_df[column]):
+                    keys[column] = pd.to_numeric(df[column], errors="coerce").astype(float)
+                else:
+                    keys[column] = df[column].astype(str)
+            return pd.MultiIndex.from_frame(pd.DataFrame(keys))
+
+        previous_keys = key_frame(rfac_df)
+        if not previous_keys.is_unique:
+            raise ValueError("The control key columns do not identify the rows of the warm start relaxation factors")
+        positions = previous_keys.get_indexer(key_frame(self.controls_df))
+        found = positions >= 0
+        rfac = np.ones_like(self.targets)
+        for j, control in enumerate(self.controls):
+            if f"R_{control}" in rfac_df.columns:
+                values = rfac_df[f"R_{control}"].to_numpy(dtype=float)[positions[found]]
+                rfac[found, j] = np.where(np.isfinite(values) & (values > 0), values, 1.0)
+        return rfac
+
+    def replicate(self, multiplier: np.ndarray) -> "SurveyExpansion":
+        """
+        Returns the expansion of a replicate sample, in which each record counts `multiplier`
+        times (see `replicate_multipliers`). The replicate shares the incidence matrix and group
+        codes of this expansion; only the initial weights and the weight bounds are scaled.
+        """
+        replicate = copy.copy(self)
+        replicate.initial_weight = self.initial_weight * multiplier
+        replicate.min_weight = self.min_weight * multiplier
+        replicate.max_weight = self.max_weight * multiplier
+        return replicate
+
+    def fit_control(
+        self,
+        j: int,
+        weight: np.ndarray,
+        rfac: np.ndarray,
+        trace: Optional[ConvergenceTrace] = None,
+    ) -> np.ndarray:
+        """
+        Newton-Raphson update of control `j`: updates the relaxation factors of the control in
+        `rfac` and the weights of the incident records in `weight`, in place, and the weight
+        statistics of `trace` if given.
+
+        Returns:
+            np.ndarray: The correction of each row of the controls table.
+        """
+        rows, x, codes = self.control_entries(j)
+        matched = codes >= 0
+        rows, x, codes = rows[matched], x[matched], codes[matched]
+        num_groups = len(self.targets)
+        xw = x * weight[rows]
+        sum_value = np.bincount(codes, weights=xw, minlength=num_groups)
+        sum_value_sq = np.bincount(codes, weights=x * xw, minlength=num_groups)
+
+        target = self.targets[:, j]
+        relax = rfac[:, j]
+        priority = self.priority[j]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correction = np.where(
+                (sum_value > 0) & (target > 0),
+                1 - (sum_value - target * relax) / (sum_value_sq + target * relax / priority),
+                1.0,
+            )
+            # as in R, a control row without records has no correction
+            correction[~self.has_records[:, j] & (target > 0)] = np.nan
+            rfac[:, j] = np.where((target > 0) & ~np.isnan(correction), relax * (1 / correction) ** (1 / priority), relax)
+
+            incident = x > 0
+            rows, x, codes = rows[incident], x[incident], codes[incident]
+            previous = weight[rows]
+            adjusted = previous * correction[codes] ** x
+            weight[rows] = np.minimum(np.maximum(adjusted, self.min_weight[rows]), self.max_weight[rows])
+        if trace is not None:
+            trace.update_weights(weight, rows, previous)
+        return correction
+
+    def fit_all_controls(self, weight: np.ndarray, rfac: np.ndarray) -> np.ndarray:
+        """
+        Newton step of all the controls jointly: updates the relaxation factors in `rfac` and
+        the weights in `weight`, in place.
+
+        This is raking with bounds. The weights are
+        `clip(initial_weight * exp(sum of incidence * multiplier), min_weight, max_weight)`, with
+        a multiplier per control and row of the controls table, and each target is relaxed to
+        `target * exp(-multiplier / priority)`, so the relaxation factors are the multipliers
+        scaled by the priorities, as in `fit_control`. The step solves the linearized control
+        equations for all the multipliers at once, with the Jacobian
+        `incidence * diag(free weights) * incidence' + diag(target * rfac / priority)`, where
+        the weights at their bounds are not free. It is halved until the control gaps shrink; if
+        they do not shrink with a 64th of the step, the step is rejected and the pass fits one
+        control at a time instead (see `fit_control`).
+
+        Returns:
+            np.ndarray: The correction (`exp` of the change of the multiplier) of each row of the
+                controls table by controls.
+        """
+        priority = np.broadcast_to(self.priority, self.targets.shape).ravel()
+        target = self.targets.ravel()
+        active = self.fitted.ravel()
+        incidence = self.grouped_incidence[np.flatnonzero(active)]
+        target, priority = target[active], priority[active]
+        multiplier = -priority * np.log(rfac.ravel()[active])
+
+        def weights(multiplier):
+            with np.errstate(over="ignore"):
+                unbounded = self.initial_weight * np.exp(np.minimum(incidence.T @ multiplier, 700))
+            bounded = np.minimum(np.maximum(unbounded, self.min_weight), self.max_weight)
+            return bounded, unbounded
+
+        def residual(multiplier, weight):
+            return incidence @ weight - target * np.exp(-multiplier / priority)
+
+        current, unbounded = weights(multiplier)
+        gap = residual(multiplier, current)
+        free = (unbounded > self.min_weight) & (unbounded < self.max_weight)
+        jacobian = (incidence.multiply(current * free) @ incidence.T).toarray()
+        jacobian[np.diag_indices_from(jacobian)] += target * np.exp(-multiplier / priority) / priority
+        try:
+            step = np.linalg.solve(jacobian, -gap)
+        except np.linalg.LinAlgError:
+            step = np.linalg.lstsq(jacobian, -gap, rcond=None)[0]
+
+        size = 1.0
+        norm = np.linalg.norm(gap / target)
+        while size >= 1 / 64:
+            updated, _ = weights(multiplier + size * step)
+            if np.linalg.norm(residual(multiplier + size * step, updated) / target) < norm:
+                break
+            size /= 2
+        else:
+            # no fraction of the step reduces the gaps (the weight bounds make the problem
+            # non-smooth), so the step is rejected and the controls are fitted one at a time
+            weight[:] = current
+            correction = np.ones_like(self.targets)
+            for j in range(len(self.controls)):
+                correction[:, j] = self.fit_control(j, weight, rfac)
+            return correction
+
+        correction = np.ones(self.targets.size)
+        correction[active] = np.exp(size * step)
+        correction = correction.reshape(self.targets.shape)
+        # as in `fit_control`, a control row without records has no correction
+        correction[~self.has_records & (self.targets > 0)] = np.nan
+        relax = rfac.ravel()
+        relax[active] = np.exp(-(multiplier + size * step) / priority)
+        rfac[:] = relax.reshape(rfac.shape)
+        weight[:] = updated
+        return correction
+
+    def run(
+        self,
+        max_iteration: int = 50,
+        control_tolerance: Optional[float] = None,
+        weight_tolerance: Optional[float] = None,
+        method: str = "sequential",
+        initial_weight: Optional[np.ndarray] = None,
+        initial_rfac: Optional[np.ndarray] = None,
+        trace: str = "control",
+    ) -> tuple:
+        """
+        Runs up to `max_iteration` passes over the controls.
+
+        The `sequential` method updates one control at a time (see `fit_control`), as in the R
+        notebook. The `simultaneous` method updates all the controls jointly in each pass (see
+        `fit_all_controls`), so it needs fewer passes when there are many controls; its
+        convergence statistics show, for each control, the corrections of the joint step. Both
+        respect the weight bounds and the control priorities.
+
+        After each pass, the fit is assessed
+        with the largest relative gap between a control and its relaxed target (see `control_gap`)
+        and the largest relative change of a weight over the pass. The run stops as soon as both are
+        within their tolerance; a tolerance that is not given is not checked, and without
+        tolerances all `max_iteration` passes are run, as in the R notebook.
+
+        Args:
+            max_iteration (int): Maximum number of passes over the controls.
+            control_tolerance (float, optional): Tolerance of the largest relative control gap.
+            weight_tolerance (float, optional): Tolerance of the largest relative weight change.
+            method (str): `sequential` or `simultaneous`.
+            initial_weight (np.ndarray, optional): Weights to start from, e.g. from
+                `seed_weights`. The `simultaneous` method derives the weights from the
+                relaxation factors and ignores them with a warning.
+            initial_rfac (np.ndarray, optional): Relaxation factors to start from, e.g. from
+                `seed_rfac`.
+            trace (str): Granularity of the convergence statistics, `control` or `iteration`.
+                See `ConvergenceTrace`.
+
+        Returns:
+            tuple: The weights (aligned with the survey records), the relaxation factors (rows of
+                the controls table by controls), the convergence statistics and the assessment of
+                each pass (see `CONVERGENCE_COLUMNS`).
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown expansion method '{method}', expected one of {METHODS}")
+        if method == "simultaneous" and initial_weight is not None:
+            warnings.warn(
+                "The simultaneous method derives the weights from the relaxation factors, the "
+                "initial weights are ignored; warm start it from the relaxation factors instead"
+            )
+            initial_weight = None
+        weight = (self.initial_weight if initial_weight is None else initial_weight).copy()
+        rfac = np.ones_like(self.targets) if initial_rfac is None else initial_rfac.copy()
+        stats = ConvergenceTrace(self.controls, max_iteration, weight, trace)
+        convergence = []
+        check = control_tolerance is not None or weight_tolerance is not None
+        for iteration in range(1, max_iteration + 1):
+            previous_weight = weight.copy()
+            if method == "sequential":
+                for j in range(len(self.controls)):
+                    stats.add(iteration, j, self.fit_control(j, weight, rfac, stats))
+            else:
+                corrections = self.fit_all_controls(weight, rfac)
+                stats.reset_weights(weight)
+                for j in range(len(self.controls)):
+                    stats.add(iteration, j, corrections[:, j])
+            stats.end_iteration(iteration, weight)
+
+            gap = self.control_gap(weight, rfac)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                change = np.abs(weight - previous_weight) / previous_weight
+            change = float(np.nanmax(change)) if len(change) else 0.0
+            converged = check and (
+                (control_tolerance is None or gap <= control_tolerance)
+                and (weight_tolerance is None or change <= weight_tolerance)
+            )
+            convergence.append([iteration, gap, change, converged])
+            if converged:
+                break
+        return (
+            weight, rfac, stats.frame(),
+            pd.DataFrame(convergence, columns=CONVERGENCE_COLUMNS),
+        )
+
+    def rfac_frame(self, rfac: np.ndarray) -> pd.DataFrame:
+        """
+        Returns the relaxation factors with the control key columns, one `R_<control>` column per
+        control.
+        """
+        columns = list(dict.fromkeys(column for key in self.control_keys for column in key_columns(key)))
+        rfac_df = self.controls_df[columns].copy()
+        for j, control in enumerate(self.controls):
+            rfac_df[f"R_{control}"] = rfac[:, j]
+        return rfac_df
+
+
+def fit_expansion(
+    config: ExpansionConfig,
+    survey_df: pd.DataFrame,
+    controls_df: pd.DataFrame,
+    config_df: pd.DataFrame,
+    incidence: Optional[sparse.sparray] = None,
+) -> dict:
+    """
+    Fits the weights of the prepared records (see `prepare_survey`) to the controls.
+
+    Returns:
+        dict: `weight` (aligned with the records) and data frames `rfac`, `stats` and
+            `convergence` (see `SurveyExpansion.run`).
+    """
+    expansion = SurveyExpansion(
+        survey_df,
+        controls_df,
+        config_df,
+        config.scaling_factor_low,
+        config.scaling_factor_high,
+        incidence=incidence,
+    )
+    initial_weight = initial_rfac = None
+    if config.warm_start_weights_file is not None:
+        initial_weight = expansion.seed_weights(pd.read_csv(config.warm_start_weights_file))
+    if config.warm_start_rfac_file is not None:
+        initial_rfac = expansion.seed_rfac(pd.read_csv(config.warm_start_rfac_file))
+    weight, rfac, stats_df, convergence_df = expansion.run(
+        config.max_iteration,
+        config.control_tolerance,
+        config.weight_tolerance,
+        config.method,
+        initial_weight,
+        initial_rfac,
+        config.trace,
+    )
+    last = convergence_df.iloc[-1]
+    print(
+        f"{config.name or 'expansion'}: "
+        f"{'converged after' if last['converged'] else 'stopped at'} iteration {last['iter']}, "
+        f"max control gap {last['max_control_gap']:.2e}, max weight change {last['max_weight_change']:.2e}"
+    )
+    return {"weight": weight, "rfac": expansion.rfac_frame(rfac), "stats": stats_df, "convergence": convergence_df}
+
+
+def expansion_results(
+    config: ExpansionConfig,
+    prepared_df: pd.DataFrame,
+    fit: dict,
+    write: bool = True,
+    id_column: str = "unique_id",
+) -> dict:
+    """
+    Attaches the fitted weights to the prepared records and writes the output files named in
+    `config`.
+
+    Returns:
+        dict: See `run_expansion`.
+    """
+    expanded_df = prepared_df.drop(columns=[COUNT_COLUMN]).assign(weight=fit["weight"])
+    results = {
+        "weights": expanded_df[[id_column, "weight"]],
+        "rfac": fit["rfac"],
+        "stats": fit["stats"],
+        "convergence": fit["convergence"],
+        "survey": expanded_df,
+    }
+    if write:
+        for key, file in [
+            ("survey", config.survey_expanded_file),
+            ("stats", config.stat_file),
+            ("rfac", config.rfac_file),
+            ("weights", config.weights_only_file),
+        ]:
+            if file is not None:
+                results[key].to_csv(file, index=False)
+    return results
+
+
+def run_expansion(config: ExpansionConfig, survey_df: Optional[pd.DataFrame] = None, write: bool = True) -> dict:
+    """
+    Runs an expansion and writes its output files.
+
+    Args:
+        config (ExpansionConfig): The expansion, e.g. from `ExpansionConfig.from_yaml`.
+        survey_df (pd.DataFrame, optional): The survey data. Read from `config.survey_file` by
+            default.
+        write (bool): Write the output files named in `config`.
+
+    Returns:
+        dict: Data frames `weights` (`unique_id`, `weight`), `rfac`, `stats`, `convergence`
+            (see `SurveyExpansion.run`) and `survey` (the expanded records).
+    """
+    if survey_df is None:
+        survey_df = pd.read_csv(config.survey_file, low_memory=False)
+    prepared_df = prepare_survey(survey_df, config.departing_only, config.non_sas_only)
+    fit = fit_expansion(
+        config, prepared_df, read_controls(config.controls_file), read_control_config(config.config_file)
+    )
+    return expansion_results(config, prepared_df, fit, write)
+
+
+def fit_columns(config_df: pd.DataFrame, id_column: str = "unique_id") -> list:
+    """
+    Returns the survey columns a fit reads besides the control values: the record id, the
+    index keys, the market segment and the initial weight.
+    """
+    columns = [id_column, "marketsegment", "weight"]
+    columns += [column for key in config_df["indexkey"] for column in key_columns(key)]
+    return list(dict.fromkeys(columns))
+
+
+def run_expansions(
+    configs: list,
+    survey_df: Optional[pd.DataFrame] = None,
+    write: bool = True,
+    max_workers: Optional[int] = None,
+) -> dict:
+    """
+    Runs several expansions of the same survey, e.g. all the `expansion_config_*.yaml` files.
+
+    The survey is read and prepared once, and each distinct control expression is evaluated
+    once over all the valid records. The incidence of each expansion is then a selection of
+    the rows and columns of that shared matrix, and the fits run in parallel processes, each
+    receiving only its incidence and the few survey columns it needs.
+
+    Args:
+        configs (list): The expansions (`ExpansionConfig`). They must use the same survey file.
+        survey_df (pd.DataFrame, optional): The survey data. Read from the survey file of the
+            configurations by default.
+        write (bool): Write the output files named in each configuration.
+        max_workers (int, optional): Number of processes. Defaults to one per expansion, up to
+            the number of CPUs.
+
+    Returns:
+        dict: The results of each expansion (see `run_expansion`), by expansion name.
+    """
+    names = [config.name or str(i) for i, config in enumerate(configs)]
+    if len(set(names)) < len(names):
+        raise ValueError(f"Expansion names are not unique: {names}")
+
+    survey_files = {os.path.abspath(config.survey_file) for config in configs}
+    if survey_df is None:
+        if len(survey_files) > 1:
+            raise ValueError(f"The expansions use different survey files: {sorted(survey_files)}")
+        survey_df = pd.read_csv(configs[0].survey_file, low_memory=False)
+    valid_df = prepare_survey(survey_df)
+
+    config_dfs = [read_control_config(config.config_file) for config in configs]
+    expressions = {}
+    for config_df in config_dfs:
+        for text in config_df["expression"]:
+            if text not in expressions:
+                expressions[text] = ControlExpression(text)
+    shared_incidence = evaluate_incidence(valid_df, list(expressions.values()))
+    expression_index = {text: i for i, text in enumerate(expressions)}
+
+    tasks = []
+    for config, config_df in zip(configs, config_dfs):
+        rows = np.flatnonzero(scenario_rows(valid_df, config.departing_only, config.non_sas_only))
+        columns = [column for column in fit_columns(config_df) if column in valid_df.columns]
+        incidence = shared_incidence[rows][:, [expression_index[text] for text in config_df["expression"]]]
+        tasks.append((
+            config,
+            valid_df.loc[rows, columns].reset_index(drop=True),
+            read_controls(config.controls_file),
+            config_df,
+            incidence,
+        ))
+
+    max_workers = max_workers or min(len(tasks), os.cpu_count() or 1)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            fits = list(executor.map(fit_expansion, *zip(*tasks)))
+    else:
+        fits = [fit_expansion(*task) for task in tasks]
+
+    results = {}
+    for name, config, fit in zip(names, configs, fits):
+        rows = scenario_rows(valid_df, config.departing_only, config.non_sas_only)
+        prepared_df = valid_df if rows.all() else valid_df[rows].reset_index(drop=True)
+        results[name] = expansion_results(config, prepared_df, fit, write)
+    return results
+
+
+def replicate_multipliers(
+    strata: np.ndarray,
+    replicates: int,
+    method: str = "bootstrap",
+    seed: Optional[int] = None,
+) -> tuple:
+    """
+    Draws the record multipliers of replicate samples, by stratum.
+
+    With `bootstrap`, each replicate draws `n - 1` of the `n` records of each stratum with
+    replacement, and a record drawn `k` times counts `k * n / (n - 1)` times (the rescaled
+    bootstrap). With `jackknife`, the records of each stratum are randomly spread over
+    `replicates` groups, and each replicate drops one group, the other records of the stratum
+    counting `n / (n - n_dropped)` times (the delete-a-group jackknife). Strata with one record
+    are kept as they are.
+
+    Args:
+        strata (np.ndarray): Stratum code of each record.
+        replicates (int): Number of replicates.
+        method (str): `bootstrap` or `jackknife`.
+        seed (int, optional): Seed of the random draws.
+
+    Returns:
+        tuple: The multipliers (records by replicates) and the factor of the replicate variance,
+            `sum((estimate_r - estimate)^2) * factor`.
+    """
+    if method not in REPLICATE_METHODS:
+        raise ValueError(f"Unknown replicate method '{method}', expected one of {REPLICATE_METHODS}")
+    rng = np.random.default_rng(seed)
+    multiplier = np.ones((len(strata), replicates), dtype=np.float32)
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        size = len(members)
+        if size < 2:
+            continue
+        if method == "bootstrap":
+            draws = rng.integers(0, size, size=(replicates, size - 1))
+            counts = np.apply_along_axis(np.bincount, 1, draws, minlength=size)
+            multiplier[members] = (counts * size / (size - 1)).T
+        else:
+            groups = np.empty(size, dtype=np.int64)
+            groups[rng.permutation(size)] = np.arange(size) % replicates
+            dropped = np.bincount(groups, minlength=replicates)
+            kept = np.where(dropped < size, size / np.maximum(size - dropped, 1), 0.0)
+            multiplier[members] = kept
+            multiplier[members, groups] = 0.0
+    factor = 1 / replicates if method == "bootstrap" else (replicates - 1) / replicates
+    return multiplier, factor
+
+
+_replicate_state = {}
+"""
+The expansion and run settings of the replicate processes, see `run_replicates`.
+"""
+
+
+def start_replicates(expansion_args: tuple, run_args: dict):
+    """
+    Builds the expansion of a replicate process once, from the shared incidence matrix.
+    """
+    _replicate_state["expansion"] = SurveyExpansion(*expansion_args)
+    _replicate_state["run_args"] = run_args
+
+
+def fit_replicate(multiplier: np.ndarray) -> np.ndarray:
+    """
+    Fits the weights of one replicate in a replicate process, see `SurveyExpansion.replicate`.
+    """
+    run_args = dict(_replicate_state["run_args"])
+    run_args["initial_weight"] = run_args["initial_weight"] * multiplier
+    weight = _replicate_state["expansion"].replicate(multiplier).run(**run_args)[0]
+    return weight.astype(np.float32)
+
+
+def run_replicates(
+    config: ExpansionConfig,
+    replicates: int = 100,
+    method: str = "bootstrap",
+    strata: Optional[list] = None,
+    seed: Optional[int] = None,
+    survey_df: Optional[pd.DataFrame] = None,
+    write: bool = True,
+    max_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Computes replicate weights of an expansion, for the margins of error of weighted estimates.
+
+    The control expressions are evaluated once, and each process builds one expansion from
+    that incidence matrix; the replicates only change the initial weights and bounds of the
+    records (see `replicate_multipliers`). Each replicate starts from the weights and
+    relaxation factors of the full sample, so it converges in fewer passes, and uses the
+    `max_iteration`, tolerances and method of `config`.
+
+    Args:
+        config (ExpansionConfig): The expansion.
+        replicates (int): Number of replicates.
+        method (str): `bootstrap` or `jackknife`.
+        strata (list, optional): Survey columns defining the strata. Defaults to
+            `REPLICATE_STRATA`.
+        seed (int, optional): Seed of the random draws.
+        survey_df (pd.DataFrame, optional): The survey data. Read from `config.survey_file` by
+            default.
+        write (bool): Write the replicate weights to `config.replicate_weights_file`, as Parquet
+            if the file name ends with `.parquet` and as csv otherwise.
+        max_workers (int, optional): Number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        pd.DataFrame: `unique_id`, `weight` (full sample) and one float32 `rep_<r>` column per
+            replicate. `attrs["variance_factor"]` holds the factor of the replicate variance.
+    """
+    if survey_df is None:
+        survey_df = pd.read_csv(config.survey_file, low_memory=False)
+    prepared_df = prepare_survey(survey_df, config.departing_only, config.non_sas_only)
+    controls_df = read_controls(config.controls_file)
+    config_df = read_control_config(config.config_file)
+    incidence = evaluate_incidence(prepared_df, [ControlExpression(text) for text in config_df["expression"]])
+    columns = [column for column in fit_columns(config_df) if column in prepared_df.columns]
+    expansion_args = (
+        prepared_df[columns],
+        controls_df,
+        config_df,
+        config.scaling_factor_low,
+        config.scaling_factor_high,
+        "unique_id",
+        incidence,
+    )
+
+    full = fit_expansion(config, *expansion_args[:3], incidence=incidence)
+    expansion = SurveyExpansion(*expansion_args)
+    run_args = {
+        "max_iteration": config.max_iteration,
+        "control_tolerance": config.control_tolerance,
+        "weight_tolerance": config.weight_tolerance,
+        "method": config.method,
+        "initial_weight": full["weight"],
+        "initial_rfac": expansion.seed_rfac(full["rfac"]),
+        "trace": "iteration",
+    }
+
+    strata_codes = prepared_df.groupby(strata or REPLICATE_STRATA, sort=False).ngroup().to_numpy()
+    multiplier, factor = replicate_multipliers(strata_codes, replicates, method, seed)
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers, initializer=start_replicates, initargs=(expansion_args, run_args)) as executor:
+            weights = list(executor.map(fit_replicate, multiplier.T, chunksize=max(1, replicates // (4 * max_workers))))
+    else:
+        start_replicates(expansion_args, run_args)
+        weights = [fit_replicate(column) for column in multiplier.T]
+
+    replicate_df = pd.concat(
+        [
+            prepared_df[["unique_id"]].assign(weight=full["weight"]),
+            pd.DataFrame(np.column_stack(weights), columns=[f"rep_{r + 1}" for r in range(replicates)]),
+        ],
+        axis=1,
+    )
+    replicate_df.attrs["variance_factor"] = factor
+    if write and config.replicate_weights_file is not None:
+        if config.replicate_weights_file.endswith(".parquet"):
+            replicate_df.to_parquet(config.replicate_weights_file, index=False, compression="zstd")
+        else:
+            replicate_df.to_csv(config.replicate_weights_file, index=False)
+    return replicate_df
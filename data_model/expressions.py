@@ -0,0 +1,360 @@
+"""
+Control expressions: the R snippets of the `expansion_controls_expressions_*.csv` files, such as
+`ifelse(inbound_or_outbound==1 & main_mode %in% c(15), party_size_flight, 0)`, parsed once and
+compiled to vectorized NumPy over the survey columns.
+
+Only a small part of R is accepted, so an expression can read survey columns but do nothing else:
+
+- numbers, strings in single or double quotes, `TRUE`/`FALSE` and column names;
+- arithmetic `+ - * /`, comparisons `== != < <= > >=`, logical `! & && | ||` and parentheses;
+- `x %in% c(...)` with a vector of constants, and `ifelse(condition, yes, no)`.
+
+Operators have the precedence they have in R.
+"""
+
+import re
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?L?)
+        |(?P<string>"[^"]*"|'[^']*')
+        |(?P<name>[A-Za-z.][A-Za-z0-9._]*|`[^`]+`)
+        |(?P<operator>%in%|==|!=|<=|>=|&&|\|\||[-+*/<>!&|(),])
+    )
+    """,
+    re.VERBOSE,
+)
+"""
+Tokens of the expression language.
+"""
+
+CONSTANTS = {"TRUE": True, "FALSE": False, "T": True, "F": False}
+"""
+Logical constants.
+"""
+
+COMPARISONS = {
+    "==": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+"""
+Comparison operators.
+"""
+
+ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.true_divide}
+"""
+Arithmetic operators.
+"""
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits an expression into `(kind, value)` tokens.
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ValueError(f"Unexpected character '{text[position:].lstrip()[:1]}' in expression: {text}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.startswith("`"):
+            value = value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+def as_logical(values):
+    """
+    Returns values as booleans, non-zero numbers being true as in R.
+    """
+    values = np.asarray(values)
+    return values if values.dtype == bool else values != 0
+
+
+def as_text(value):
+    """
+    Formats a number as R does when comparing it to strings, e.g. `1` as `"1"`.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float, np.number)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def is_text(values) -> bool:
+    """
+    Checks whether values are strings.
+    """
+    if isinstance(values, str):
+        return True
+    return isinstance(values, np.ndarray) and values.dtype.kind in "OUS"
+
+
+def compare(operator: str, left, right):
+    """
+    Compares two operands. As in R, a number compared to strings is compared as a string.
+    """
+    if is_text(left) != is_text(right):
+        if is_text(left):
+            right = np.vectorize(as_text, otypes=[object])(right) if isinstance(right, np.ndarray) else as_text(right)
+        else:
+            left = np.vectorize(as_text, otypes=[object])(left) if isinstance(left, np.ndarray) else as_text(left)
+    return COMPARISONS[operator](left, right)
+
+
+class ControlExpression:
+    """
+    A control expression compiled to a function of the survey columns.
+
+    The expression is parsed once, when the object is created, into nested Python functions
+    that each apply one NumPy operation to whole columns, so evaluating it costs one vectorized
+    operation per operator. Unknown functions and operators are rejected when parsing; nothing
+    in the expression is passed to `eval`.
+    """
+
+    def __init__(self, text: str):
+        """
+        Args:
+            text (str): The expression, e.g. `ifelse(marketsegment==2,1,0)`.
+
+        Raises:
+            ValueError: If the expression is not valid.
+        """
+        self.text = text
+        self.columns = set()
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.function = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.tokens[self.position][1]}' in expression: {text}")
+        del self.tokens, self.position
+
+    def __repr__(self) -> str:
+        return f"ControlExpression({self.text!r})"
+
+    def evaluate(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Evaluates the expression over the survey records.
+
+        Returns:
+            np.ndarray: The value of the expression for each record, as floats.
+
+        Raises:
+            ValueError: If a column of the expression is not in `df`.
+        """
+        missing = sorted(self.columns - set(df.columns))
+        if missing:
+            raise ValueError(f"Columns {missing} of expression '{self.text}' not found in the survey data")
+        columns = {column: df[column].to_numpy() for column in self.columns}
+        values = np.asarray(self.function(columns), dtype=float)
+        return np.broadcast_to(values, len(df)).copy()
+
+    def peek(self):
+        """
+        Returns the value of the next token, or None at the end of the expression.
+        """
+        return self.tokens[self.position][1] if self.position < len(self.tokens) else None
+
+    def next(self) -> tuple:
+        """
+        Consumes and returns the next token.
+        """
+        if self.position >= len(self.tokens):
+            raise ValueError(f"Unexpected end of expression: {self.text}")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, value: str):
+        """
+        Consumes the next token, which must be the operator `value`.
+        """
+        kind, found = self.next()
+        if found != value or kind != "operator":
+            raise ValueError(f"Expected '{value}' instead of '{found}' in expression: {self.text}")
+
+    def parse_or(self) -> Callable:
+        """
+        Parses `a | b`, the lowest precedence.
+        """
+        left = self.parse_and()
+        while self.peek() in ("|", "||"):
+            self.next()
+            right = self.parse_and()
+            left = (lambda a, b: lambda c: np.logical_or(as_logical(a(c)), as_logical(b(c))))(left, right)
+        return left
+
+    def parse_and(self) -> Callable:
+        """
+        Parses `a & b`.
+        """
+        left = self.parse_not()
+        while self.peek() in ("&", "&&"):
+            self.next()
+            right = self.parse_not()
+            left = (lambda a, b: lambda c: np.logical_and(as_logical(a(c)), as_logical(b(c))))(left, right)
+        return left
+
+    def parse_not(self) -> Callable:
+        """
+        Parses `!a`.
+        """
+        if self.peek() == "!":
+            self.next()
+            operand = self.parse_not()
+            return lambda c: np.logical_not(as_logical(operand(c)))
+        return self.parse_comparison()
+
+    def parse_comparison(self) -> Callable:
+        """
+        Parses `a == b` and the other comparisons.
+        """
+        left = self.parse_additive()
+        if self.peek() in COMPARISONS:
+            operator = self.next()[1]
+            right = self.parse_additive()
+            return lambda c: compare(operator, left(c), right(c))
+        return left
+
+    def parse_additive(self) -> Callable:
+        """
+        Parses `a + b` and `a - b`.
+        """
+        left = self.parse_multiplicative()
+        while self.peek() in ("+", "-"):
+            operation = ARITHMETIC[self.next()[1]]
+            right = self.parse_multiplicative()
+            left = (lambda a, b, f: lambda c: f(a(c), b(c)))(left, right, operation)
+        return left
+
+    def parse_multiplicative(self) -> Callable:
+        """
+        Parses `a * b` and `a / b`.
+        """
+        left = self.parse_in()
+        while self.peek() in ("*", "/"):
+            operation = ARITHMETIC[self.next()[1]]
+            right = self.parse_in()
+            left = (lambda a, b, f: lambda c: f(a(c), b(c)))(left, right, operation)
+        return left
+
+    def parse_in(self) -> Callable:
+        """
+        Parses `a %in% c(...)`.
+        """
+        left = self.parse_unary()
+        while self.peek() == "%in%":
+            self.next()
+            values = self.parse_vector()
+            left = (lambda a, v: lambda c: self.isin(a(c), v))(left, values)
+        return left
+
+    @staticmethod
+    def isin(values, choices: list):
+        """
+        Checks which values are in `choices`, comparing numbers to strings as text.
+        """
+        if is_text(values) and not all(isinstance(choice, str) for choice in choices):
+            choices = [as_text(choice) for choice in choices]
+        return np.isin(values, choices)
+
+    def parse_vector(self) -> list:
+        """
+        Parses the constants of a `c(...)` vector, or a single constant.
+        """
+        kind, value = self.next()
+        if kind == "name" and value == "c" and self.peek() == "(":
+            self.next()
+            values = []
+            while self.peek() != ")":
+                values.append(self.parse_constant())
+                if self.peek() == ",":
+                    self.next()
+                elif self.peek() != ")":
+                    raise ValueError(f"Expected ',' or ')' in c() of expression: {self.text}")
+            self.next()
+            return values
+        self.position -= 1
+        return [self.parse_constant()]
+
+    def parse_constant(self):
+        """
+        Parses a number, string or logical constant.
+        """
+        sign = 1
+        if self.peek() == "-":
+            self.next()
+            sign = -1
+        kind, value = self.next()
+        if kind == "number":
+            return sign * float(value.rstrip("L"))
+        if kind == "string" and sign == 1:
+            return value[1:-1]
+        if kind == "name" and value in CONSTANTS and sign == 1:
+            return CONSTANTS[value]
+        raise ValueError(f"Expected a constant instead of '{value}' in expression: {self.text}")
+
+    def parse_unary(self) -> Callable:
+        """
+        Parses `-a` and `+a`.
+        """
+        if self.peek() in ("-", "+"):
+            operator = self.next()[1]
+            operand = self.parse_unary()
+            return operand if operator == "+" else (lambda c: np.negative(operand(c)))
+        return self.parse_primary()
+
+    def parse_primary(self) -> Callable:
+        """
+        Parses a constant, a column, a function call or an expression in parentheses.
+        """
+        kind, value = self.next()
+        if kind == "number":
+            number = float(value.rstrip("L"))
+            return lambda c: number
+        if kind == "string":
+            text = value[1:-1]
+            return lambda c: text
+        if kind == "operator" and value == "(":
+            inner = self.parse_or()
+            self.expect(")")
+            return inner
+        if kind == "name" and self.peek() == "(":
+            return self.parse_call(value)
+        if kind == "name" and value in CONSTANTS:
+            constant = CONSTANTS[value]
+            return lambda c: constant
+        if kind == "name":
+            self.columns.add(value)
+            return lambda c: c[value]
+        raise ValueError(f"Unexpected '{value}' in expression: {self.text}")
+
+    def parse_call(self, name: str) -> Callable:
+        """
+        Parses `ifelse(condition, yes, no)`, the only function.
+        """
+        if name != "ifelse":
+            raise ValueError(f"Function '{name}' is not supported in expression: {self.text}")
+        self.expect("(")
+        condition = self.parse_or()
+        self.expect(",")
+        if_true = self.parse_or()
+        self.expect(",")
+        if_false = self.parse_or()
+        self.expect(")")
+        return lambda c: np.where(as_logical(condition(c)), if_true(c), if_false(c))
@@ -0,0 +1,456 @@
+"""
+Pre-processing of the raw survey data delivered by the field team.
+"""
+
+from functools import cached_property
+from typing import NamedTuple, Optional
+import glob
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import enums as e
+
+
+PARQUET_SAFE_TYPES = (
+    "string", "empty", "boolean", "integer", "floating", "mixed-integer-float", "decimal",
+    "date", "datetime", "datetime64", "time", "bytes",
+)
+"""
+Values pandas infers for object columns that Parquet stores as they are.
+"""
+
+MIXED_STRINGS_SUFFIX = "__strings"
+"""
+Suffix of the column holding the strings of a column that mixes numbers and strings in the cache.
+"""
+
+
+def file_digest(file: str, block_size: int = 1 << 20) -> str:
+    """
+    Returns the sha1 hex digest of the contents of a file.
+    """
+    digest = hashlib.sha1()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_rename_map(variable_map_file: str) -> dict:
+    """
+    Reads `revised_names.csv`, which maps the variable names used by the field team (`ETC_name`)
+    to the data model names (`WSP_name`). Columns mapped to `delete` are dropped.
+    """
+    header_df = pd.read_csv(variable_map_file)[["ETC_name", "WSP_name"]]
+    return pd.Series(header_df.WSP_name.values, index=header_df.ETC_name).to_dict()
+
+
+def rename_raw_columns(df: pd.DataFrame, rename_map: dict) -> pd.DataFrame:
+    """
+    Renames the columns of a raw sheet with the `revised_names.csv` map and drops the columns
+    mapped to `delete`.
+    """
+    df = df.rename(columns=rename_map)
+    df = df.loc[:, df.columns != "delete"]
+    duplicated = df.columns[df.columns.duplicated()].unique().tolist()
+    if duplicated:
+        raise ValueError(f"more than one column is renamed to {duplicated}")
+    return df
+
+
+def encode_mixed_columns(df: pd.DataFrame) -> tuple:
+    """
+    Prepares a raw sheet for Parquet. Excel columns often mix numeric codes with strings (e.g.
+    `-oth-` or `13B`), which Parquet cannot store in one column. The numbers of such a column
+    are kept in the column and its strings are moved to a `__strings` column, so
+    `decode_mixed_columns` can restore the original values.
+
+    Returns:
+        tuple: The encoded data frame and the list of mixed columns.
+    """
+    mixed = []
+    encoded = {}
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) in PARQUET_SAFE_TYPES:
+            continue
+        values = df[col]
+        is_string = values.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+        numbers = pd.to_numeric(values.where(~is_string), errors="coerce")
+        if numbers.notna().sum() != (values.notna().to_numpy() & ~is_string).sum():
+            # neither numbers nor strings (e.g. dates mixed with text): keep the text
+            print(f"Column '{col}' mixes types that are cached as strings")
+            encoded[col] = values.astype("string")
+            continue
+        is_number = values.notna().to_numpy() & ~is_string
+        if not values[is_number].map(lambda x: isinstance(x, (float, np.floating))).any():
+            numbers = numbers.astype("Int64")
+        encoded[col] = numbers
+        encoded[col + MIXED_STRINGS_SUFFIX] = values.where(is_string).astype("string")
+        mixed.append(col)
+
+    if not encoded:
+        return df, mixed
+    df = df.assign(**{col: encoded[col] for col in encoded if col in df.columns})
+    strings = {col: values for col, values in encoded.items() if col not in df.columns}
+    return pd.concat([df, pd.DataFrame(strings, index=df.index)], axis=1), mixed
+
+
+def decode_mixed_columns(df: pd.DataFrame, mixed: list) -> pd.DataFrame:
+    """
+    Restores the columns split by `encode_mixed_columns` to object columns of numbers and strings.
+    """
+    if not mixed:
+        return df
+    decoded = {}
+    for col in mixed:
+        values = df[col].to_numpy(dtype=object, na_value=np.nan)
+        strings = df[col + MIXED_STRINGS_SUFFIX]
+        has_string = strings.notna().to_numpy()
+        values[has_string] = strings[has_string].to_numpy(dtype=object)
+        decoded[col] = values
+    df = df.drop(columns=[col + MIXED_STRINGS_SUFFIX for col in mixed])
+    return df.assign(**decoded)
+
+
+def read_cache_file(cache_file: str) -> pd.DataFrame:
+    """
+    Reads a sheet cached by `read_excel_cached`, restoring its mixed columns.
+    """
+    df = pd.read_parquet(cache_file)
+    mixed = json.loads(df.attrs.get("mixed_columns", "[]"))
+    return decode_mixed_columns(df, mixed)
+
+
+def read_excel_cached(
+    file: str,
+    sheet_name: int = 0,
+    cache_dir: Optional[str] = None,
+    variable_map_file: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Reads a sheet of a delivery workbook, converting it once to a Parquet file in `cache_dir`.
+    The cache file is named after the workbook and keyed by the contents of the workbook and of
+    the rename map, so a new delivery (or a revised `revised_names.csv`) is converted again and
+    the stale cache files of the sheet are removed.
+
+    Args:
+        file (str): Path to the Excel workbook.
+        sheet_name (int): Sheet to read, as in `pd.read_excel`.
+        cache_dir (str, optional): Folder of the Parquet files. Defaults to an `etc_cache`
+            folder next to the workbook.
+        variable_map_file (str, optional): Path to `revised_names.csv`. If given, the columns are
+            renamed (see `rename_raw_columns`) before caching.
+
+    Returns:
+        pd.DataFrame: The sheet, renamed if a rename map is given.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file), "etc_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = hashlib.sha1(f"{file_digest(file)}|{sheet_name}".encode())
+    if variable_map_file is not None:
+        key.update(file_digest(variable_map_file).encode())
+    prefix = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(file))[0]}_{sheet_name}_")
+    cache_file = f"{prefix}{key.hexdigest()[:16]}.parquet"
+
+    if os.path.exists(cache_file):
+        return read_cache_file(cache_file)
+
+    df = pd.read_excel(file, sheet_name=sheet_name)
+    if variable_map_file is not None:
+        df = rename_raw_columns(df, read_rename_map(variable_map_file))
+
+    encoded_df, mixed = encode_mixed_columns(df)
+    encoded_df.attrs["mixed_columns"] = json.dumps(mixed)
+    for stale_file in glob.glob(f"{glob.escape(prefix)}*.parquet"):
+        os.remove(stale_file)
+    encoded_df.to_parquet(cache_file, index=False)
+    # read back, so the sheet has the same values and dtypes whether or not it was cached
+    return read_cache_file(cache_file)
+
+
+class RawSurveyData:
+    """
+    The workbooks delivered by the field team, read through a Parquet cache (see
+    `read_excel_cached`) and renamed with `revised_names.csv`. Each workbook has a sheet of
+    complete and a sheet of incomplete responses; the Stated Preference (SP) workbook is joined
+    to the others by `respondentid`. The frames are read when first used, so only the sheets a
+    step needs are loaded.
+    """
+
+    def __init__(
+        self,
+        intercept_file: str,
+        pilot_file: str,
+        sas_file: str,
+        sp_file: str,
+        variable_map_file: str,
+        cache_dir: Optional[str] = None,
+        complete_sheet: int = 0,
+        incomplete_sheet: int = 1,
+        sp_sheet: int = 1,
+    ):
+        """
+        Args:
+            intercept_file (str): Main intercept survey responses.
+            pilot_file (str): Pilot survey (also intercept) responses.
+            sas_file (str): Self-administered survey (SAS) responses.
+            sp_file (str): Stated Preference survey responses.
+            variable_map_file (str): Path to `revised_names.csv`.
+            cache_dir (str, optional): Folder of the Parquet cache, see `read_excel_cached`.
+            complete_sheet (int): Sheet of the complete responses in the RP workbooks.
+            incomplete_sheet (int): Sheet of the incomplete responses in the RP workbooks.
+            sp_sheet (int): Sheet of the responses in the SP workbook.
+        """
+        self.intercept_file = intercept_file
+        self.pilot_file = pilot_file
+        self.sas_file = sas_file
+        self.sp_file = sp_file
+        self.variable_map_file = variable_map_file
+        self.cache_dir = cache_dir
+        self.complete_sheet = complete_sheet
+        self.incomplete_sheet = incomplete_sheet
+        self.sp_sheet = sp_sheet
+
+    def sheet(self, file: str, sheet_name: int, is_self_administered: Optional[bool] = None) -> pd.DataFrame:
+        """
+        Returns a renamed sheet, adding the `is_self_administered` flag if given.
+        """
+        df = read_excel_cached(file, sheet_name, self.cache_dir, self.variable_map_file)
+        if is_self_administered is not None:
+            df["is_self_administered"] = is_self_administered
+        return df
+
+    def _rp_sheets(self, sheet_name: int) -> list:
+        return [
+            self.sheet(self.intercept_file, sheet_name, False),
+            self.sheet(self.pilot_file, sheet_name, False),
+            self.sheet(self.sas_file, sheet_name, True),
+        ]
+
+    @cached_property
+    def complete(self) -> pd.DataFrame:
+        """
+        Complete responses of the intercept, pilot and SAS workbooks, in that order.
+        """
+        return pd.concat(self._rp_sheets(self.complete_sheet), ignore_index=True)
+
+    @cached_property
+    def incomplete(self) -> pd.DataFrame:
+        """
+        Incomplete responses of the intercept, pilot and SAS workbooks, in that order.
+        """
+        return pd.concat(self._rp_sheets(self.incomplete_sheet), ignore_index=True)
+
+    @cached_property
+    def pilot(self) -> pd.DataFrame:
+        """
+        Complete and incomplete responses of the pilot workbook.
+        """
+        return pd.concat(
+            [self.sheet(self.pilot_file, self.complete_sheet, False), self.sheet(self.pilot_file, self.incomplete_sheet, False)],
+            ignore_index=True,
+        )
+
+    @cached_property
+    def sas(self) -> pd.DataFrame:
+        """
+        Complete and incomplete responses of the SAS workbook.
+        """
+        return pd.concat(
+            [self.sheet(self.sas_file, self.complete_sheet, True), self.sheet(self.sas_file, self.incomplete_sheet, True)],
+            ignore_index=True,
+        )
+
+    @cached_property
+    def sp(self) -> pd.DataFrame:
+        """
+        Stated Preference survey responses.
+        """
+        return self.sheet(self.sp_file, self.sp_sheet)
+
+
+class Recode(NamedTuple):
+    """
+    One column recode: the values of `source` are looked up in the value map named `recode` of
+    the recode table (see `read_recode_table`) and written to `target`.
+    """
+
+    source: str
+    """The column whose values are looked up"""
+
+    target: str
+    """The column the recoded values are written to, which may be `source`"""
+
+    recode: str
+    """The name of the value map in the recode table"""
+
+    ignore_case: bool = False
+    """Whether string values are matched regardless of case; other values are then not matched"""
+
+    update_only: bool = False
+    """Whether only the records whose value is in the map are changed; by default, values not in
+    the map become missing, as with `pd.Series.map`"""
+
+
+def recode_value(value: str):
+    """
+    Converts a value of the recode table: `EnumName.MEMBER` becomes the member's value, integers
+    become `int`, an empty value becomes None, anything else stays a string.
+    """
+    if pd.isna(value) or value == "":
+        return None
+    enum_name, _, member = value.partition(".")
+    if member and hasattr(e, enum_name) and member in getattr(e, enum_name).__members__:
+        return getattr(e, enum_name)[member].value
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def value_key(value, ignore_case: bool = False):
+    """
+    Returns the key a value is matched on: strings as they are (lower case with `ignore_case`),
+    whole numbers as `int`, so that 1, 1.0 and `TravelMode.WALK` match each other.
+    """
+    if isinstance(value, str):
+        return value.lower() if ignore_case else value
+    if ignore_case or pd.isna(value):
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return int(value)
+    return value
+
+
+class RecodeMap:
+    """
+    A value map of the recode table, compiled for lookups on the unique values of a column.
+    """
+
+    def __init__(self, name: str, from_values: list, to_values: list):
+        self.name = name
+        self.from_values = from_values
+        self.to_values = to_values
+        self._keys = {}
+
+    def keys(self, ignore_case: bool = False) -> dict:
+        """
+        Returns the map from match keys (see `value_key`) to the recoded values.
+        """
+        if ignore_case not in self._keys:
+            keys = {}
+            for from_value, to_value in zip(self.from_values, self.to_values):
+                key = value_key(from_value, ignore_case)
+                if key in keys and keys[key] != to_value:
+                    raise ValueError(f"recode '{self.name}' maps '{from_value}' to more than one value")
+                keys[key] = to_value
+            self._keys[ignore_case] = keys
+        return self._keys[ignore_case]
+
+    def apply(self, values: pd.Series, ignore_case: bool = False) -> tuple:
+        """
+        Recodes a column. Only the unique values are looked up; the result is taken from them by
+        the factorized codes of the column.
+
+        Returns:
+            tuple: The recoded values (an array aligned with `values`), a boolean array flagging
+                the records whose value is in the map, and a Series with the number of records of
+                each value that is not in the map.
+        """
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        keys = self.keys(ignore_case)
+        unique_keys = [value_key(value, ignore_case) for value in uniques]
+        unique_found = np.array([key in keys for key in unique_keys] + [False])
+        unique_values = [keys.get(key) for key in unique_keys]
+
+        recoded = pd.Series(unique_values + [None], dtype=object)
+        if recoded.map(lambda x: isinstance(x, (int, float)) or x is None).all():
+            recoded = recoded.astype(float)
+            if recoded[unique_found].notna().all() and unique_found[codes].all():
+                recoded = recoded.fillna(0).astype(np.int64)
+        recoded = recoded.to_numpy()[codes]
+
+        found = unique_found[codes]
+        unmapped = pd.Series(np.bincount(codes[codes >= 0], minlength=len(uniques)), index=uniques)
+        unmapped = unmapped[~unique_found[:-1] & (unmapped > 0)]
+        return recoded, found, unmapped
+
+
+def read_recode_table(file: str) -> dict:
+    """
+    Reads the recode table, e.g. `recodes.csv`, with one row per recoded value: the name of the
+    value map (`recode`), the value to replace (`from_value`) and the new value (`to_value`).
+    Values may be strings, integers, or Enum members written as `EnumName.MEMBER`; an empty
+    `to_value` makes the value missing.
+
+    Returns:
+        dict: Map name to `RecodeMap`.
+    """
+    table = pd.read_csv(file, dtype=str, keep_default_na=False)
+    return {
+        name: RecodeMap(
+            name,
+            [recode_value(value) for value in rows["from_value"]],
+            [recode_value(value) for value in rows["to_value"]],
+        )
+        for name, rows in table.groupby("recode", sort=False)
+    }
+
+
+def apply_recodes(df: pd.DataFrame, recodes: list, recode_maps: dict) -> tuple:
+    """
+    Applies a list of `Recode`s to a data frame in order, so a recode can use the result of an
+    earlier one. Each column is recoded with a single lookup of its unique values. Values not
+    found in the maps are reported with a warning.
+
+    Args:
+        df (pd.DataFrame): The survey data; modified in place.
+        recodes (list): The `Recode`s to apply.
+        recode_maps (dict): Value maps from `read_recode_table`.
+
+    Raises:
+        ValueError: If the source column, the value map or, with `update_only`, the target
+            column of a recode does not exist; the data frame is then left unchanged.
+
+    Returns:
+        tuple: The recoded data frame and a data frame of the values not found in the maps, with
+            the source and target columns, the value and the number of records.
+    """
+    # check every recode before changing the data, allowing for columns created by earlier recodes
+    columns = set(df.columns)
+    for recode in recodes:
+        if recode.source not in columns:
+            raise ValueError(f"Column '{recode.source}' of recode '{recode.recode}' not found")
+        if recode.recode not in recode_maps:
+            raise ValueError(f"Recode '{recode.recode}' not found in the recode table")
+        if recode.update_only and recode.target not in columns:
+            raise ValueError(f"Column '{recode.target}' updated by recode '{recode.recode}' not found")
+        columns.add(recode.target)
+
+    unmapped_list = []
+    for recode in recodes:
+        recoded, found, unmapped = recode_maps[recode.recode].apply(df[recode.source], recode.ignore_case)
+        if recode.update_only:
+            target = df[recode.target].to_numpy(dtype=object if recoded.dtype == object else float, copy=True)
+            target[found] = recoded[found]
+            recoded = target
+        df[recode.target] = recoded
+        unmapped_list.append(pd.DataFrame({
+            "source": recode.source,
+            "target": recode.target,
+            "value": unmapped.index,
+            "count": unmapped.to_numpy(),
+        }))
+
+    unmapped_df = pd.concat(unmapped_list, ignore_index=True) if unmapped_list else pd.DataFrame(
+        columns=["source", "target", "value", "count"]
+    )
+    for (source, target), rows in unmapped_df.groupby(["source", "target"], sort=False):
+        warnings.warn(f"{source} -> {target}: {rows['count'].sum()} records with {len(rows)} values not in the recode map")
+    return df, unmapped_df
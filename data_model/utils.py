@@ -3,21 +3,215 @@ Utility functions used with the data model.
 """
 
 from collections import defaultdict
-from typing import Any, get_origin, get_args, Annotated, Optional
+from functools import lru_cache
+from datetime import date, datetime
+from types import UnionType
+from typing import Any, get_origin, get_args, Annotated, NamedTuple, Optional, Union
 from enum import Enum, IntEnum
+import hashlib
+import os
+import shutil
+import warnings
+import numpy as np
 import pandas as pd
+from pydantic import BaseModel
 import enums as e
 
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
 
+
+class ZoneGridIndex:
+    """
+    Raster index of a fixed zone system used to speed up point-in-polygon lookups.
+
+    The bounding box of the zones is divided into square cells (in degrees, WGS84). Each cell
+    stores the code of the zone that fully contains it, `OUTSIDE` if it touches no zone, or
+    `BOUNDARY` if it straddles a zone edge. Points falling in interior or outside cells are
+    resolved with an array lookup; only points in boundary cells are tested against the
+    exact geometry.
+    """
+
+    OUTSIDE = -1
+    BOUNDARY = -2
+
+    def __init__(
+        self,
+        grid: np.ndarray,
+        origin: tuple,
+        cell_size: float,
+        zones_gdf: gpd.GeoDataFrame,
+        zone_column: str,
+        fingerprint: str = "",
+    ):
+        self.grid = grid
+        self.origin = origin
+        self.cell_size = cell_size
+        self.zones_gdf = zones_gdf
+        self.zone_column = zone_column
+        self.zone_values = zones_gdf[zone_column].to_numpy()
+        self.fingerprint = fingerprint
+        self._tree = shapely.STRtree(zones_gdf.geometry.values)
+
+    @staticmethod
+    def shapefile_fingerprint(shapefile: str, zone_column: str, cell_size: float) -> str:
+        """
+        Hashes the shapefile geometry and attribute files together with the grid settings, so a
+        cached grid is rebuilt whenever the zone system or the resolution changes.
+        """
+        digest = hashlib.sha1(f"{zone_column}|{cell_size!r}".encode())
+        stem, _ = os.path.splitext(shapefile)
+        for path in (shapefile, stem + ".dbf"):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    @classmethod
+    def from_shapefile(
+        cls,
+        shapefile: str,
+        zone_column: str,
+        cell_size: float = 0.002,
+        cache_file: Optional[str] = None,
+    ) -> "ZoneGridIndex":
+        """
+        Builds the grid index for a shapefile, re-using `cache_file` when it was built from the
+        same shapefile and cell size.
+
+        Args:
+            shapefile (str): Path to the shapefile containing zone geometries.
+            zone_column (str): Column name in the shapefile that contains zone names.
+            cell_size (float): Width and height of a grid cell, in degrees.
+            cache_file (str, optional): Path to a `.npz` file used to store the grid between runs.
+
+        Returns:
+            ZoneGridIndex: The grid index.
+        """
+        zones_gdf: gpd.GeoDataFrame = gpd.read_file(shapefile).to_crs(epsg=4326)
+        zones_gdf = zones_gdf.reset_index(drop=True)
+        fingerprint = cls.shapefile_fingerprint(shapefile, zone_column, cell_size)
+
+        if cache_file is not None and os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            if str(cached["fingerprint"]) == fingerprint:
+                return cls(
+                    cached["grid"],
+                    tuple(cached["origin"]),
+                    float(cached["cell_size"]),
+                    zones_gdf,
+                    zone_column,
+                    fingerprint,
+                )
+
+        index = cls.build(zones_gdf, zone_column, cell_size)
+        index.fingerprint = fingerprint
+        if cache_file is not None:
+            index.save(cache_file)
+        return index
+
+    @classmethod
+    def build(cls, zones_gdf: gpd.GeoDataFrame, zone_column: str, cell_size: float) -> "ZoneGridIndex":
+        """
+        Classifies every grid cell over the extent of `zones_gdf` (which must be in EPSG:4326).
+        """
+        min_x, min_y, max_x, max_y = zones_gdf.total_bounds
+        n_cols = int(np.ceil((max_x - min_x) / cell_size)) + 1
+        n_rows = int(np.ceil((max_y - min_y) / cell_size)) + 1
+
+        # Mark every cell crossed by a zone edge. Edges are split so no segment is longer than a
+        # cell, which means the cells under a segment's bounding box cover the segment.
+        rings = shapely.get_parts(shapely.boundary(zones_gdf.geometry.values))
+        rings = shapely.segmentize(rings, cell_size)
+        coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+        same_ring = ring_idx[1:] == ring_idx[:-1]
+        start, end = coords[:-1][same_ring], coords[1:][same_ring]
+        col_lo = np.floor((np.minimum(start[:, 0], end[:, 0]) - min_x) / cell_size).astype(np.intp)
+        col_hi = np.floor((np.maximum(start[:, 0], end[:, 0]) - min_x) / cell_size).astype(np.intp)
+        row_lo = np.floor((np.minimum(start[:, 1], end[:, 1]) - min_y) / cell_size).astype(np.intp)
+        row_hi = np.floor((np.maximum(start[:, 1], end[:, 1]) - min_y) / cell_size).astype(np.intp)
+
+        is_boundary = np.zeros((n_rows, n_cols), dtype=bool)
+        for d_row in range(int((row_hi - row_lo).max(initial=0)) + 1):
+            for d_col in range(int((col_hi - col_lo).max(initial=0)) + 1):
+                keep = (row_lo + d_row <= row_hi) & (col_lo + d_col <= col_hi)
+                is_boundary[
+                    np.clip(row_lo[keep] + d_row, 0, n_rows - 1),
+                    np.clip(col_lo[keep] + d_col, 0, n_cols - 1),
+                ] = True
+
+        # A run of non-boundary cells along a row is not crossed by any edge, so it lies in a
+        # single zone (or outside all of them). Test one cell per run against the geometry.
+        flat_boundary = is_boundary.ravel()
+        previous_boundary = np.roll(is_boundary, 1, axis=1)
+        previous_boundary[:, 0] = True
+        run_start = ~flat_boundary & previous_boundary.ravel()
+        run_id = np.cumsum(run_start) - 1
+
+        start_cells = np.flatnonzero(run_start)
+        start_points = shapely.points(
+            min_x + (start_cells % n_cols + 0.5) * cell_size,
+            min_y + (start_cells // n_cols + 0.5) * cell_size,
+        )
+        run_zone = np.full(start_cells.shape[0], cls.OUTSIDE, dtype=np.int32)
+        point_idx, zone_idx = shapely.STRtree(zones_gdf.geometry.values).query(start_points, predicate="within")
+        first = np.unique(point_idx, return_index=True)[1]
+        run_zone[point_idx[first]] = zone_idx[first]
+
+        grid = np.full(n_rows * n_cols, cls.BOUNDARY, dtype=np.int32)
+        grid[~flat_boundary] = run_zone[run_id[~flat_boundary]]
+
+        return cls(grid.reshape(n_rows, n_cols), (min_x, min_y), cell_size, zones_gdf, zone_column)
+
+    def save(self, cache_file: str) -> None:
+        """
+        Writes the grid to a compressed `.npz` file.
+        """
+        np.savez_compressed(
+            cache_file,
+            grid=self.grid,
+            origin=np.asarray(self.origin),
+            cell_size=np.asarray(self.cell_size),
+            fingerprint=np.asarray(self.fingerprint),
+        )
+
+    def lookup_codes(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """
+        Returns the position of the containing zone in `zones_gdf` for each point, or `OUTSIDE`.
+        Points with missing coordinates are returned as `OUTSIDE`.
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        codes = np.full(lat.shape[0], self.OUTSIDE, dtype=np.int32)
+
+        row = np.floor((lat - self.origin[1]) / self.cell_size)
+        col = np.floor((lon - self.origin[0]) / self.cell_size)
+        n_rows, n_cols = self.grid.shape
+        in_grid = (row >= 0) & (row < n_rows) & (col >= 0) & (col < n_cols)
+        codes[in_grid] = self.grid[row[in_grid].astype(np.intp), col[in_grid].astype(np.intp)]
+
+        boundary = np.flatnonzero(codes == self.BOUNDARY)
+        codes[boundary] = self.OUTSIDE
+        if boundary.size:
+            points = shapely.points(lon[boundary], lat[boundary])
+            point_idx, zone_idx = self._tree.query(points, predicate="within")
+            # keep the first zone when zones overlap, matching the order of the shapefile
+            first = np.unique(point_idx, return_index=True)[1]
+            codes[boundary[point_idx[first]]] = zone_idx[first]
+
+        return codes
+
+
 def map_zones(
-    df: pd.DataFrame, 
-    lat_col: str, 
-    long_col: str, 
-    shapefile: str, 
-    zone_column: str, 
-    external_zone_value: Any
+    df: pd.DataFrame,
+    lat_col: str,
+    long_col: str,
+    shapefile: str,
+    zone_column: str,
+    external_zone_value: Any,
+    grid_cache_file: Optional[str] = None,
+    grid_cell_size: float = 0.002,
 ) -> gpd.GeoDataFrame:
     """
     Maps coordinates in a DataFrame to zones defined in a shapefile.
@@ -30,10 +224,21 @@ def map_zones(
         zone_column (str): Column name in the shapefile that contains zone names.
         external_zone_value (Any): Value to return if a point is not within any zone
             in the shapefile.
+        grid_cache_file (str, optional): If provided, zones are looked up with a `ZoneGridIndex`
+            cached at this path instead of a spatial join. Intended for fixed zone systems such
+            as the PMSA and municipal boundaries.
+        grid_cell_size (float): Grid cell size, in degrees, used when building the grid index.
 
     Returns:
         pd.GeoDataFrame: A GeoDataFrame with zone names mapped to each row.
     """
+    if grid_cache_file is not None:
+        return map_zones_with_grid(
+            df, lat_col, long_col,
+            ZoneGridIndex.from_shapefile(shapefile, zone_column, grid_cell_size, grid_cache_file),
+            external_zone_value,
+        )
+
     # Load the shapefile into a GeoDataFrame
     zones_gdf: gpd.GeoDataFrame = gpd.read_file(shapefile)
     
@@ -69,40 +274,246 @@ def map_zones(
     return mapped_gdf.apply(get_zone, axis=1)
 
 
-
-def extract_base_type(typ):
+def map_zones_with_grid(
+    df: pd.DataFrame,
+    lat_col: str,
+    long_col: str,
+    zone_index: ZoneGridIndex,
+    external_zone_value: Any,
+) -> pd.Series:
     """
-    Extracts base type from complex annotations. This is needed to identify whether a variable 
-    is an Enum. Without this step, the origin of all the variables in the model is Annotated, even the variable is an Enum
+    Maps coordinates in a DataFrame to zones using a precomputed `ZoneGridIndex`. Returns the same
+    values as `map_zones`: None where coordinates are missing, `external_zone_value` where the
+    point is not within any zone, and the zone name otherwise.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame with latitude and longitude columns.
+        lat_col (str): Column name for latitude in the DataFrame.
+        long_col (str): Column name for longitude in the DataFrame.
+        zone_index (ZoneGridIndex): Grid index built for the zone system.
+        external_zone_value (Any): Value to return if a point is not within any zone.
+
+    Returns:
+        pd.Series: The zone name for each row of `df`.
     """
+    lat = pd.to_numeric(df[lat_col], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(df[long_col], errors="coerce").to_numpy(dtype=float)
+    codes = zone_index.lookup_codes(lat, lon)
+
+    zones = np.full(codes.shape[0], external_zone_value, dtype=object)
+    matched = codes >= 0
+    zones[matched] = zone_index.zone_values[codes[matched]]
+    zones[np.isnan(lat) | np.isnan(lon)] = None
+
+    return pd.Series(zones, index=df.index, dtype=object)
+
+
+
+def _unwrap_base_type(typ):
     origin = get_origin(typ)
     if origin is not Enum:      
         base = get_args(typ)
         if base:
-           base = extract_base_type(base[0])
+           base = _unwrap_base_type(base[0])
            return base
     return typ
 
 
-def add_enum_label_columns(df,model) -> pd.DataFrame:
+def _is_optional_type(typ) -> bool:
+    origin = get_origin(typ)
+    if origin is Annotated:
+        return _is_optional_type(get_args(typ)[0])
+    if origin is Union or origin is UnionType:
+        return any(arg is type(None) or _is_optional_type(arg) for arg in get_args(typ))
+    return False
+
+
+def _storage_dtype(base_type) -> np.dtype:
+    if not isinstance(base_type, type):
+        return np.dtype(object)
+    if issubclass(base_type, Enum):
+        values = [item.value for item in base_type]
+        if not all(isinstance(value, int) for value in values):
+            return np.dtype(object)
+        for dtype in (np.int8, np.int16, np.int32):
+            if np.iinfo(dtype).min <= min(values) and max(values) <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.int64)
+    if issubclass(base_type, bool):
+        return np.dtype(bool)
+    if issubclass(base_type, int):
+        return np.dtype(np.int64)
+    if issubclass(base_type, float):
+        return np.dtype(np.float64)
+    if issubclass(base_type, (datetime, date)):
+        return np.dtype("datetime64[ns]")
+    return np.dtype(object)
+
+
+class TypeInfo(NamedTuple):
+    """
+    Resolved form of a data model field annotation.
+    """
+
+    base_type: Any
+    """The innermost type, e.g. `e.TravelMode` for `NoneOrNan[e.TravelMode]`"""
+
+    is_enum: bool
+    """Whether the base type is an Enum (including IntEnum)"""
+
+    is_int_enum: bool
+    """Whether the base type is an Enum with integer values only"""
+
+    is_optional: bool
+    """Whether the annotation allows None"""
+
+    storage_dtype: np.dtype
+    """Smallest numpy dtype that holds the (non-missing) values of the field"""
+
+
+def _type_info(typ) -> TypeInfo:
+    base_type = _unwrap_base_type(typ)
+    is_enum = isinstance(base_type, type) and issubclass(base_type, Enum)
+    storage_dtype = _storage_dtype(base_type)
+    return TypeInfo(
+        base_type=base_type,
+        is_enum=is_enum,
+        is_int_enum=is_enum and storage_dtype.kind == "i",
+        is_optional=_is_optional_type(typ),
+        storage_dtype=storage_dtype,
+    )
+
+
+@lru_cache(maxsize=None)
+def _cached_type_info(typ) -> TypeInfo:
+    return _type_info(typ)
+
+
+def resolve_type(typ) -> TypeInfo:
+    """
+    Resolves a field annotation (e.g. `Annotated[Optional[e.TravelMode], ...]`) into its base type,
+    whether it is an Enum, whether it is optional, and its numpy storage dtype. Results are memoized
+    per annotation object; unhashable annotations are resolved without caching.
+
+    Used to label Enum fields, to plan the dtypes of the data model output, and to build the data dictionary.
+    """
+    try:
+        return _cached_type_info(typ)
+    except TypeError:
+        return _type_info(typ)
+
+
+def extract_base_type(typ):
+    """
+    Extracts base type from complex annotations. This is needed to identify whether a variable 
+    is an Enum. Without this step, the origin of all the variables in the model is Annotated, even the variable is an Enum.
+    The result is memoized, see `resolve_type`.
+    """
+    return resolve_type(typ).base_type
+
+
+class EnumLabelLookup:
+    """
+    Maps the values of an Enum to its labels (member names). The labels are returned as a pandas
+    Categorical whose categories are the Enum members, in the order they are defined. For Enums
+    whose values are small, non-negative integers (the IntEnums in `enums.py`), the category codes
+    are stored in an array indexed by value, so a whole column is labeled with a single `take`.
+    """
+
+    MAX_DENSE_VALUE = 1024
+
+    def __init__(self, enum_type: type):
+        self.enum_type = enum_type
+        self.names = {item.value: item.name for item in enum_type}
+        self.dtype = pd.CategoricalDtype(categories=[item.name for item in enum_type])
+        self.category_codes = None
+
+        values = list(self.names)
+        if all(isinstance(value, int) for value in values) and 0 <= min(values) and max(values) <= self.MAX_DENSE_VALUE:
+            # the extra slot at the end is used for values that are not in the Enum
+            self.category_codes = np.full(max(values) + 2, -1, dtype=np.int16)
+            for value, name in self.names.items():
+                self.category_codes[value] = self.dtype.categories.get_loc(name)
+
+    def codes(self, values: pd.Series) -> np.ndarray:
+        """
+        Returns the position of each value in the code array; missing values and values not
+        in the Enum point to the extra slot at the end.
+        """
+        numbers = values.to_numpy(dtype=float, na_value=np.nan)
+        codes = np.full(numbers.shape[0], self.category_codes.shape[0] - 1, dtype=np.intp)
+        is_code = (numbers >= 0) & (numbers < self.category_codes.shape[0] - 1) & (numbers == np.floor(numbers))
+        codes[is_code] = numbers[is_code]
+        return codes
+
+    def map(self, values: pd.Series) -> pd.Series:
+        """
+        Returns the label of each value as a categorical Series, with NaN where the value is
+        missing or not in the Enum.
+        """
+        if self.category_codes is None or not pd.api.types.is_numeric_dtype(values):
+            return values.map(self.names).astype(self.dtype)
+        labels = pd.Categorical.from_codes(self.category_codes.take(self.codes(values)), dtype=self.dtype)
+        return pd.Series(labels, index=values.index)
+
+
+@lru_cache(maxsize=None)
+def enum_label_lookup(enum_type: type) -> EnumLabelLookup:
+    """
+    Returns the (memoized) label lookup for an Enum.
+    """
+    return EnumLabelLookup(enum_type)
+
+
+@lru_cache(maxsize=None)
+def model_enum_fields(model) -> tuple:
+    """
+    Returns the Enum fields of a data model class as (field name, EnumLabelLookup) pairs. Fields
+    inherited from parent classes and computed fields are included, and the Enum fields of nested
+    models (e.g. the `Trip` of a `Respondent`) are included under their own names, matching the
+    flattened data model output. The result is computed once per class.
+    """
+    enum_fields = {}
+    field_types = {name: info.annotation for name, info in model.model_fields.items()}
+    field_types.update({name: info.return_type for name, info in model.model_computed_fields.items()})
+
+    for field, field_type in field_types.items():
+        type_info = resolve_type(field_type)
+        base_type = type_info.base_type
+        if type_info.is_enum:
+            enum_fields[field] = enum_label_lookup(base_type)
+        elif isinstance(base_type, type) and issubclass(base_type, BaseModel) and base_type is not model:
+            for nested_field, lookup in model_enum_fields(base_type):
+                enum_fields.setdefault(nested_field, lookup)
+
+    return tuple(enum_fields.items())
+
+
+def add_enum_label_columns(df, model) -> pd.DataFrame:
     """
     After the datamodel output is converted into a dataframe, this method adds a column to the output dataframe for each Enum variable in the datamodel. This column 
-    shows the Enum label.
+    shows the Enum label, as a categorical whose categories are the Enum members. Missing values and values that are not in the Enum are left blank (NaN).
+
+    The Enum variables include those inherited from parent classes, computed variables, and variables of nested models, so passing the 
+    most specific classes (e.g. `DepartingPassengerVisitor`) labels the full flattened output. Variables that are not columns of `df` are skipped.
 
     Args:
         df (pd.DataFrame): The DataFrame to which the Enum label columns will be added.
-        model (BaseModel): A Pydantic model with fields annotated with types, potentially including Enums.
+        model (BaseModel or list): A Pydantic model, or a list of models, with fields annotated with types, potentially including Enums.
 
     Returns:
         pd.DataFrame: The modified DataFrame with additional Enum label columns.
     """
-    
-    for field, field_type in model.__annotations__.items():
-        base_type = extract_base_type(field_type)
-        if issubclass(base_type,(Enum,IntEnum)):
-            enum_names = {item.value: item.name for item in base_type}
-            enum_name_col = f"{field}_label" 
-            df[enum_name_col] = df[field].map(enum_names).astype(str)
+    models = model if isinstance(model, (list, tuple)) else [model]
+
+    enum_fields = {}
+    for m in models:
+        for field, lookup in model_enum_fields(m):
+            enum_fields.setdefault(field, lookup)
+
+    for field, lookup in enum_fields.items():
+        if field in df.columns:
+            df[f"{field}_label"] = lookup.map(df[field])
     return df
 
 
@@ -132,6 +543,98 @@ def add_list_objects(
     return parent_list
 
 
+def nest_child_records(
+    child_df: pd.DataFrame,
+    child_key: str,
+    parent_df: pd.DataFrame,
+    parent_key: str,
+    parent_variable: str,
+    one_to_many: bool = False,
+) -> list:
+    """
+    Builds a list of parent records, each with its child records nested under `parent_variable`,
+    directly from a child and a parent DataFrame. The keys are factorized together so children
+    are matched to parents by integer position rather than through a dictionary of records.
+
+    With `one_to_many=False` (the default), each parent gets a single child dict (or an empty
+    dict when there is no child), as `add_list_objects` does. If a key has more than one child,
+    a warning lists the duplicate keys and the last child is used. With `one_to_many=True`, each
+    parent gets a list with all of its children, in the order they appear in `child_df`. In both
+    modes, a warning lists parent keys that appear more than once, as those parents get the same
+    children.
+
+    The records are built from the column values directly, and only the children that are
+    nested are turned into dicts.
+
+    Args:
+        child_df (pd.DataFrame): Child records.
+        child_key (str): Column in `child_df` matched to the parent. It is not included in the
+            nested child records.
+        parent_df (pd.DataFrame): Parent records.
+        parent_key (str): Column in `parent_df` matched to the child.
+        parent_variable (str): Name of the variable in the parent records holding the children.
+        one_to_many (bool): Whether to nest a list of children rather than a single child.
+
+    Returns:
+        list: A list of parent records (dicts).
+    """
+    num_children = len(child_df)
+    codes, unique_keys = pd.factorize(
+        np.concatenate([child_df[child_key].to_numpy(dtype=object), parent_df[parent_key].to_numpy(dtype=object)])
+    )
+    child_codes, parent_codes = codes[:num_children], codes[num_children:]
+
+    has_key = child_codes >= 0
+    child_positions = np.flatnonzero(has_key)
+    child_codes = child_codes[has_key]
+    counts = np.bincount(child_codes, minlength=len(unique_keys))
+
+    duplicate_keys = unique_keys[counts > 1]
+    if len(duplicate_keys) and not one_to_many:
+        warnings.warn(
+            f"{len(duplicate_keys)} {child_key} values have more than one child record, keeping the last: "
+            f"{list(duplicate_keys[:10])}"
+        )
+    parent_counts = np.bincount(parent_codes[parent_codes >= 0], minlength=len(unique_keys))
+    duplicate_parents = unique_keys[parent_counts > 1]
+    if len(duplicate_parents):
+        warnings.warn(
+            f"{len(duplicate_parents)} {parent_key} values appear in more than one parent record: "
+            f"{list(duplicate_parents[:10])}"
+        )
+
+    child_columns = [col for col in child_df.columns if col != child_key]
+    child_values = [child_df[col].tolist() for col in child_columns]
+
+    def child(position):
+        return {col: values[position] for col, values in zip(child_columns, child_values)}
+
+    parent_columns = list(parent_df.columns)
+    parents = [
+        dict(zip(parent_columns, row))
+        for row in zip(*(parent_df[col].tolist() for col in parent_columns))
+    ]
+    if not parent_columns:
+        parents = [{} for _ in range(len(parent_df))]
+
+    if one_to_many:
+        order = child_positions[np.argsort(child_codes, kind="stable")]
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        for parent, code in zip(parents, parent_codes):
+            if code < 0:
+                parent[parent_variable] = []
+            else:
+                parent[parent_variable] = [child(i) for i in order[starts[code]:starts[code + 1]]]
+    else:
+        last_child = np.full(len(unique_keys) + 1, -1)
+        np.maximum.at(last_child, child_codes, child_positions)
+        # parents without a key use the extra slot at the end, which has no child
+        for parent, position in zip(parents, last_child[parent_codes]):
+            parent[parent_variable] = child(position) if position >= 0 else {}
+
+    return parents
+
+
 def nan_to_none(cls, value: Any):
     """
     Convert nan to none to address that missing strings were being read as nan, which resulted in a value error when using using Optional[str]
@@ -177,98 +680,337 @@ def military_to_clock(military_time: str) -> str:
     return f"{clock_hours:02d}:{minutes:02d} {period}"
 
 
-def add_synthetic_records(df) -> pd.DataFrame:
+class SyntheticRecordSpec:
     """
-    Adds synthetic responses to the survey DataFrame.
+    Declarative description of how synthetic records are derived from survey records. The spec
+    is applied column by column to all of the selected records at once, so adding a field to it
+    does not add any per-record work.
+
+    Args:
+        source_filter (dict): Column values a record must have to be used as a source record.
+        set_values (dict): Columns set to a constant on every synthetic record.
+        remaps (dict): Value mappings applied to a column, e.g. departing to arriving passenger
+            segments. Values not in the mapping are kept, unless the column has a default.
+        remap_defaults (dict): Value given to the values not in the mapping of a remapped column,
+            missing values included.
+        swap_pairs (list): Pairs of columns whose values are exchanged, e.g. origin and destination.
+        mode_swaps (list): Tuples of (main column, candidate columns, invalid value). The main
+            column takes the value of the first candidate that is present and not the invalid
+            value, and that candidate takes the value of the main column.
+        copies (dict): Columns set to the source record value of another column.
+        null_fields (list): Columns set to missing on the synthetic records.
+        id_column (str): Column holding the record identifier.
+        id_prefix (str): Prefix added to the identifier of the synthetic records.
+    """
+
+    def __init__(
+        self,
+        source_filter: dict,
+        set_values: Optional[dict] = None,
+        remaps: Optional[dict] = None,
+        remap_defaults: Optional[dict] = None,
+        swap_pairs: Optional[list] = None,
+        mode_swaps: Optional[list] = None,
+        copies: Optional[dict] = None,
+        null_fields: Optional[list] = None,
+        id_column: str = "respondentid",
+        id_prefix: str = "syn-",
+    ):
+        self.source_filter = source_filter
+        self.set_values = set_values or {}
+        self.remaps = remaps or {}
+        self.remap_defaults = remap_defaults or {}
+        self.swap_pairs = swap_pairs or []
+        self.mode_swaps = mode_swaps or []
+        self.copies = copies or {}
+        self.null_fields = null_fields or []
+        self.id_column = id_column
+        self.id_prefix = id_prefix
+
+    def reversed(self) -> "SyntheticRecordSpec":
+        """
+        Returns the spec for the opposite direction, e.g. departing records from arriving records.
+        Filter and constant values on the same column are exchanged and the remaps are inverted;
+        the default of a remap becomes the value it is mapped to.
+        """
+        return SyntheticRecordSpec(
+            source_filter={col: self.set_values.get(col, value) for col, value in self.source_filter.items()},
+            set_values={col: self.source_filter.get(col, value) for col, value in self.set_values.items()},
+            remaps={col: {to: frm for frm, to in mapping.items()} for col, mapping in self.remaps.items()},
+            remap_defaults={col: self.remaps[col].get(value, value) for col, value in self.remap_defaults.items()},
+            swap_pairs=self.swap_pairs,
+            mode_swaps=self.mode_swaps,
+            copies=self.copies,
+            null_fields=self.null_fields,
+            id_column=self.id_column,
+            id_prefix=self.id_prefix,
+        )
+
+    def columns(self) -> set:
+        """
+        Returns the columns the spec reads or writes.
+        """
+        columns = {self.id_column, *self.source_filter, *self.set_values, *self.remaps, *self.null_fields}
+        columns.update(*self.copies.items())
+        for pair in self.swap_pairs:
+            columns.update(pair)
+        for main_col, candidate_cols, _ in self.mode_swaps:
+            columns.update([main_col, *candidate_cols])
+        return columns
+
+    def select_sources(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Returns a boolean mask of the records in `df` used to build synthetic records.
+        """
+        is_source = pd.Series(True, index=df.index)
+        for col, value in self.source_filter.items():
+            is_source &= (df[col] == value).fillna(False).astype(bool)
+        return is_source
+
+    def build_records(self, source: pd.DataFrame) -> pd.DataFrame:
+        """
+        Builds the synthetic records from the selected source records. Every new column is
+        computed from the source values, then all are assigned in a single step.
+        """
+        columns = {self.id_column: self.id_prefix + source[self.id_column].astype(str)}
+
+        for col, value in self.set_values.items():
+            columns[col] = value
+
+        for col, mapping in self.remaps.items():
+            columns[col] = source[col].replace(mapping)
+            if col in self.remap_defaults:
+                columns[col] = columns[col].where(source[col].isin(list(mapping)), self.remap_defaults[col])
+
+        for target, col in self.copies.items():
+            columns[target] = source[col]
+
+        for main_col, candidate_cols, invalid_value in self.mode_swaps:
+            main_value = source[main_col]
+            remaining = pd.Series(True, index=source.index)
+            for col in candidate_cols:
+                use = remaining & source[col].notna() & (source[col] != invalid_value)
+                main_value = source[col].where(use, main_value)
+                columns[col] = source[main_col].where(use, source[col])
+                remaining &= ~use
+            columns[main_col] = main_value
+
+        for first, second in self.swap_pairs:
+            columns[first], columns[second] = source[second], source[first]
+
+        for col in self.null_fields:
+            columns[col] = None
+
+        return source.assign(**columns)
+
+
+def departing_to_arriving_spec() -> SyntheticRecordSpec:
+    """
+    Returns the spec that builds synthetic arriving passenger records from valid departing
+    passenger records. Use `departing_to_arriving_spec().reversed()` to build departing records
+    from arriving records.
+
+    This is a function rather than a module constant because `enums` imports this module.
+    """
+    return SyntheticRecordSpec(
+        source_filter={
+            'passenger_type': e.PassengerType.DEPARTING,
+            'initial_etc_check': True,
+        },
+        set_values={
+            'passenger_type': e.PassengerType.ARRIVING,
+            'car_available': pd.NA,
+            'record_type_synthetic': 1,
+        },
+        remaps={
+            'inbound_or_outbound': {
+                e.InboundOutbound.INBOUND_TO_AIRPORT: e.InboundOutbound.OUTBOUND_FROM_AIRPORT,
+                e.InboundOutbound.OUTBOUND_FROM_AIRPORT: e.InboundOutbound.INBOUND_TO_AIRPORT,
+            },
+            'resident_visitor_general': {
+                e.ResidentVisitorGeneral.GOING_HOME: e.ResidentVisitorGeneral.VISITING,
+                e.ResidentVisitorGeneral.LEAVING_HOME: e.ResidentVisitorGeneral.COMING_HOME,
+            },
+            'passenger_segment': {
+                e.PassengerSegment.RESIDENT_DEPARTING: e.PassengerSegment.RESIDENT_ARRIVING,
+                e.PassengerSegment.VISITOR_DEPARTING: e.PassengerSegment.VISITOR_ARRIVING,
+            },
+        },
+        # values other than the two directions, missing ones included, become inbound
+        remap_defaults={
+            'inbound_or_outbound': e.InboundOutbound.INBOUND_TO_AIRPORT,
+        },
+        swap_pairs=[
+            ('previous_flight_origin', 'next_flight_destination'),
+            ('origin_activity_type', 'destination_activity_type'),
+            ('origin_activity_type_other', 'destination_activity_type_other'),
+            ('origin_state', 'destination_state'),
+            ('origin_place_name', 'destination_place_name'),
+            ('origin_zip', 'destination_zip'),
+            ('origin_latitude', 'destination_latitude'),
+            ('origin_longitude', 'destination_longitude'),
+            ('origin_municipal_zone', 'destination_municipal_zone'),
+            ('origin_pmsa', 'destination_pmsa'),
+            # The transit routes are not swapped:
+            # ('to_airport_transit_route_1', 'from_airport_transit_route_4'),
+            # ('to_airport_transit_route_2', 'from_airport_transit_route_3'),
+            # ('to_airport_transit_route_3', 'from_airport_transit_route_2'),
+            # ('to_airport_transit_route_4', 'from_airport_transit_route_1'),
+        ],
+        mode_swaps=[
+            ('main_mode', ['reverse_mode', 'reverse_mode_predicted'], e.TravelMode.REFUSED_NO_ANSWER),
+            ('main_mode_grouped', ['reverse_mode_grouped', 'reverse_mode_predicted_grouped'],
+             e.TravelModeGrouped.REFUSED_NO_ANSWER),
+        ],
+        copies={
+            'reverse_mode_combined': 'main_mode_grouped',
+        },
+        # Access and egress modes are not known for the reverse trip
+        null_fields=['access_mode', 'egress_mode', 'access_mode_grouped', 'egress_mode_grouped'],
+    )
+
+
+def add_synthetic_records(df, spec: Optional[SyntheticRecordSpec] = None) -> pd.DataFrame:
+    """
+    Adds synthetic responses to the survey DataFrame. By default, each valid departing passenger
+    record is copied as an arriving passenger record, with the trip ends, activities and modes flipped.
 
     Args:
         df (pd.DataFrame): The original DataFrame containing survey responses.
+        spec (SyntheticRecordSpec, optional): Describes which records are copied and how they are
+            changed. Defaults to `departing_to_arriving_spec()`.
         
     Returns:
         pd.DataFrame: A DataFrame with synthetic responses added.
     """
-     # Create a list to store synthetic records
-    synthetic_records = []
-    # Iterate through each record in the dataframe
-    for index, row in df.iterrows():
-        # Create a copy of the current row for the synthetic record
-        if row['passenger_type'] == e.PassengerType.DEPARTING and row['initial_etc_check'] == True:
-            synthetic_record = row.copy()
-
-            # Flip inbound/outbound
-            synthetic_record['respondentid'] = 'syn-' + str(row['respondentid'])
-            synthetic_record['inbound_or_outbound'] = 2 if row['inbound_or_outbound'] == 1 else 1
-            synthetic_record['passenger_type'] = e.PassengerType.ARRIVING
-            synthetic_record['car_available'] = pd.NA
-            #to-do add resident_visitor_general:
-            if row['resident_visitor_general'] == e.ResidentVisitorGeneral.GOING_HOME:
-                synthetic_record['resident_visitor_general'] = e.ResidentVisitorGeneral.VISITING
-            elif row['resident_visitor_general'] == e.ResidentVisitorGeneral.LEAVING_HOME:
-                synthetic_record['resident_visitor_general'] = e.ResidentVisitorGeneral.COMING_HOME
-
-            if row['passenger_segment'] == e.PassengerSegment.RESIDENT_DEPARTING:
-                synthetic_record['passenger_segment'] = e.PassengerSegment.RESIDENT_ARRIVING
-            elif row['passenger_segment'] == e.PassengerSegment.VISITOR_DEPARTING:
-                synthetic_record['passenger_segment'] = e.PassengerSegment.VISITOR_ARRIVING
-
-            synthetic_record['previous_flight_origin'], synthetic_record['next_flight_destination'] = row['next_flight_destination'], row['previous_flight_origin']
-
-            # Flipping the main and reverse modes:
-            if pd.notna(row['reverse_mode']) and row['reverse_mode']!=e.TravelMode.REFUSED_NO_ANSWER:
-                synthetic_record['main_mode'], synthetic_record['reverse_mode'] = row['reverse_mode'], row['main_mode']
-            elif pd.notna(row['reverse_mode_predicted']) and row['reverse_mode_predicted']!=e.TravelMode.REFUSED_NO_ANSWER:
-                synthetic_record['main_mode'], synthetic_record['reverse_mode_predicted'] = row['reverse_mode_predicted'], row['main_mode']
-
-                
-            synthetic_record['reverse_mode_combined'] = row['main_mode_grouped']
-            #Similar for grouped modes
-            if pd.notna(row['reverse_mode_grouped']) and row['reverse_mode_grouped']!=e.TravelModeGrouped.REFUSED_NO_ANSWER:
-                synthetic_record['main_mode_grouped'], synthetic_record['reverse_mode_grouped'] = row['reverse_mode_grouped'], row['main_mode_grouped']
-            elif pd.notna(row['reverse_mode_predicted_grouped']) and row['reverse_mode_predicted_grouped']!=e.TravelModeGrouped.REFUSED_NO_ANSWER:
-                synthetic_record['main_mode_grouped'], synthetic_record['reverse_mode_predicted_grouped'] = row['reverse_mode_predicted_grouped'], row['main_mode_grouped']
-            
-            #synthetic_record['main_mode_grouped'], synthetic_record['reverse_mode_combined'] = row['reverse_mode_combined'], row['main_mode_grouped']
-            # print(row['main_mode_grouped'], row['reverse_mode_combined'])
-            
-
-            # Access and Egress Modes:
-            # synthetic_record['access_mode'], synthetic_record['egress_mode'] = row['egress_mode'], row['access_mode']
-            # synthetic_record['access_mode_grouped'], synthetic_record['egress_mode_grouped'] = row['egress_mode_grouped'], row['access_mode_grouped']
-            # Set access and egress modes to None
-            synthetic_record["access_mode"] = None
-            synthetic_record["egress_mode"] = None
-            synthetic_record["access_mode_grouped"] = None
-            synthetic_record["egress_mode_grouped"] = None
-
-            # Activity Type
-            synthetic_record['origin_activity_type'], synthetic_record['destination_activity_type'] = row['destination_activity_type'], row['origin_activity_type']
-            synthetic_record['origin_activity_type_other'], synthetic_record['destination_activity_type_other'] = row['destination_activity_type_other'], row['origin_activity_type_other']
-           
-           #Location Attributes
-            synthetic_record['origin_state'], synthetic_record['destination_state'] = row['destination_state'], row['origin_state']
-            synthetic_record['origin_place_name'], synthetic_record['destination_place_name'] = row['destination_place_name'], row['origin_place_name']
-            synthetic_record['origin_zip'], synthetic_record['destination_zip'] = row['destination_zip'], row['origin_zip']
-
-            synthetic_record['origin_latitude'], synthetic_record['destination_latitude'] = row['destination_latitude'], row['origin_latitude']
-            synthetic_record['origin_longitude'], synthetic_record['destination_longitude'] = row['destination_longitude'], row['origin_longitude']
-            synthetic_record['origin_municipal_zone'], synthetic_record['destination_municipal_zone'] = row['destination_municipal_zone'], row['origin_municipal_zone']
-            synthetic_record['origin_pmsa'], synthetic_record['destination_pmsa'] = row['destination_pmsa'], row['origin_pmsa']
-
-
-            #synthetic_record['to_airport_transit_route_1'], synthetic_record['from_airport_transit_route_4'] = row['from_airport_transit_route_4'], row['to_airport_transit_route_1']
-            #synthetic_record['to_airport_transit_route_2'], synthetic_record['from_airport_transit_route_3'] = row['from_airport_transit_route_3'], row['to_airport_transit_route_2']
-            #synthetic_record['to_airport_transit_route_3'], synthetic_record['from_airport_transit_route_2'] = row['from_airport_transit_route_2'], row['to_airport_transit_route_3']
-            #synthetic_record['to_airport_transit_route_4'], synthetic_record['from_airport_transit_route_1'] = row['from_airport_transit_route_1'], row['to_airport_transit_route_4']
-
-
-            # Append the synthetic record to the list
-            synthetic_record['record_type_synthetic'] = 1
-            synthetic_records.append(synthetic_record)
-    
-    # Convert the list of synthetic records to a DataFrame
-    synthetic_df = pd.DataFrame(synthetic_records)
+    if spec is None:
+        spec = departing_to_arriving_spec()
+    synthetic_df = spec.build_records(df.loc[spec.select_sources(df)])
 
     # Concatenate the original and synthetic dataframes
     combined_df = pd.concat([df, synthetic_df], ignore_index=True)
 
     return combined_df
+
+
+def iter_synthetic_records(chunks, spec: Optional[SyntheticRecordSpec] = None):
+    """
+    Yields the synthetic responses for each chunk of survey responses, without holding the
+    original and synthetic records for the whole survey in memory at once.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): Chunks of survey responses, e.g. from
+            `pd.read_csv(..., chunksize=...)`.
+        spec (SyntheticRecordSpec, optional): Describes which records are copied and how they are
+            changed. Defaults to `departing_to_arriving_spec()`.
+
+    Yields:
+        pd.DataFrame: The synthetic responses built from each chunk (possibly empty).
+    """
+    if spec is None:
+        spec = departing_to_arriving_spec()
+    for chunk in chunks:
+        yield spec.build_records(chunk.loc[spec.select_sources(chunk)])
+
+
+def csv_dtypes(input_csv: str, chunksize: int = 50000, usecols: Optional[list] = None) -> dict:
+    """
+    Returns one dtype per column of a csv file, consistent across all chunks of the file, so that
+    reading it in chunks parses and formats every chunk the same way. Columns that are integers in
+    every chunk where they have values are read as nullable `Int64`, numeric columns as float64,
+    logical columns as nullable `boolean`, and anything else (including columns that are never
+    filled) as object. Only `usecols` are read, if given.
+    """
+    kinds = {}
+    for chunk in pd.read_csv(input_csv, usecols=usecols, chunksize=chunksize, low_memory=False):
+        for col in chunk.columns:
+            column_kinds = kinds.setdefault(col, set())
+            if chunk[col].isna().all():
+                continue
+            dtype = chunk[col].dtype
+            if pd.api.types.is_bool_dtype(dtype):
+                column_kinds.add("boolean")
+            elif pd.api.types.is_integer_dtype(dtype):
+                column_kinds.add("Int64")
+            elif pd.api.types.is_float_dtype(dtype):
+                values = chunk[col].dropna().to_numpy()
+                column_kinds.add("Int64" if np.all(np.mod(values, 1) == 0) else "float64")
+            else:
+                column_kinds.add("object")
+
+    dtypes = {}
+    for col, column_kinds in kinds.items():
+        if column_kinds == {"boolean"}:
+            dtypes[col] = "boolean"
+        elif column_kinds == {"Int64"}:
+            dtypes[col] = "Int64"
+        elif column_kinds and column_kinds <= {"Int64", "float64"}:
+            dtypes[col] = "float64"
+        else:
+            dtypes[col] = "object"
+    return dtypes
+
+
+def write_synthetic_records(
+    input_csv: str,
+    output_csv: str,
+    chunksize: int = 50000,
+    spec: Optional[SyntheticRecordSpec] = None,
+    include_original: bool = True,
+) -> int:
+    """
+    Streams a survey csv file through `iter_synthetic_records` and writes the result to
+    `output_csv`. With `include_original`, the output has the same row order as
+    `add_synthetic_records`: all original records first, then all synthetic records.
+
+    The original records are copied from the input file as they are. Only the columns of the
+    spec are parsed, with dtypes fixed for the whole file (see `csv_dtypes`) so that all chunks
+    are written with the same number formatting; the other columns of the synthetic records
+    keep the text of their source records. Only one chunk is held in memory at a time.
+
+    Args:
+        input_csv (str): Path to the survey responses.
+        output_csv (str): Path of the file to write.
+        chunksize (int): Number of input rows read at a time.
+        spec (SyntheticRecordSpec, optional): Describes which records are copied and how they are
+            changed. Defaults to `departing_to_arriving_spec()`.
+        include_original (bool): Whether to write the original records ahead of the synthetic ones.
+
+    Returns:
+        int: The number of synthetic records written.
+
+    Raises:
+        ValueError: If columns of the spec are not in the input file.
+    """
+    if spec is None:
+        spec = departing_to_arriving_spec()
+    columns = list(pd.read_csv(input_csv, nrows=0).columns)
+    spec_columns = [col for col in columns if col in spec.columns()]
+    missing = sorted(spec.columns() - set(columns))
+    if missing:
+        raise ValueError(f"Columns {missing} of the synthetic record spec not found in {input_csv}")
+    dtypes = dict.fromkeys(columns, str) | csv_dtypes(input_csv, chunksize, usecols=spec_columns)
+
+    if include_original:
+        with open(input_csv, "rb") as source, open(output_csv, "wb") as target:
+            shutil.copyfileobj(source, target)
+            if target.tell():
+                source.seek(-1, os.SEEK_END)
+                if source.read(1) != b"\n":
+                    target.write(b"\n")
+    else:
+        pd.DataFrame(columns=columns).to_csv(output_csv, index=False)
+
+    num_synthetic = 0
+    chunks = pd.read_csv(
+        input_csv,
+        chunksize=chunksize,
+        dtype=dtypes,
+        keep_default_na=False,
+        na_values={col: [""] for col in spec_columns},
+    )
+    for synthetic_df in iter_synthetic_records(chunks, spec):
+        synthetic_df[columns].to_csv(output_csv, mode="a", header=False, index=False)
+        num_synthetic += len(synthetic_df)
+
+    return num_synthetic
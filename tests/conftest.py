@@ -0,0 +1,11 @@
+import os
+import sys
+
+DATA_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_model")
+
+# the data model reads its lookup files from ../data, as it does when run from the notebooks
+os.chdir(DATA_MODEL_DIR)
+sys.path.insert(0, DATA_MODEL_DIR)
+
+# utils and enums import each other, enums has to be imported first
+import enums  # noqa: E402,F401
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_io
+from data_io import apply_dtypes, attach_weights, export_final_data, parquet_sibling
+
+
+@pytest.fixture
+def survey_files(tmp_path):
+    data = pd.DataFrame({
+        "unique_id": [1, 2, 3, 4, 5, 6],
+        "is_valid_record": [True, True, True, False, True, True],
+        "comment": [None, None, "late flight", "n/a", None, "rebooked"],
+        "num_stops": [None, None, 1, 2, 0, 3],
+        "weight_departing_only": [1.5, 2.0, 2.5, 3.0, 3.5, 4.0],
+        "dropped": [1, 2, 3, 4, 5, 6],
+    })
+    input_file = tmp_path / "data_model_output.csv"
+    data.to_csv(input_file, index=False)
+    plan_file = tmp_path / "columns_to_keep.csv"
+    pd.DataFrame({"column": ["dropped", "comment"], "status": ["delete", "note"]}).to_csv(plan_file, index=False)
+    return str(input_file), str(tmp_path / "final_data.csv"), str(plan_file)
+
+
+def test_export_final_data_column_empty_in_first_chunk(survey_files):
+    input_file, output_file, plan_file = survey_files
+
+    num_records = export_final_data(input_file, output_file, plan_file, chunksize=2)
+
+    assert num_records == 5
+    with open(output_file) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == "unique_id,is_valid_record,note,num_stops,weight_departing_only"
+    assert [line.split(",")[3] for line in lines[1:]] == ["", "", "1", "0", "3"]
+
+    final_df = pd.read_parquet(parquet_sibling(output_file))
+    assert str(final_df["note"].dtype) == "string"
+    assert final_df["note"].fillna("").tolist() == ["", "", "late flight", "", "rebooked"]
+    assert str(final_df["num_stops"].dtype) == "Int64"
+    assert not os.path.exists(output_file + ".tmp")
+    assert not os.path.exists(parquet_sibling(output_file) + ".tmp")
+
+
+def test_export_final_data_keeps_previous_output_on_failure(survey_files, monkeypatch):
+    input_file, output_file, plan_file = survey_files
+    with open(output_file, "w") as file:
+        file.write("previous\n")
+
+    chunks = []
+
+    def fail_on_second_chunk(df, dtypes):
+        chunks.append(df)
+        if len(chunks) == 2:
+            raise ValueError("bad chunk")
+        return apply_dtypes(df, dtypes)
+
+    monkeypatch.setattr(data_io, "apply_dtypes", fail_on_second_chunk)
+    with pytest.raises(ValueError, match="bad chunk"):
+        export_final_data(input_file, output_file, plan_file, chunksize=2)
+
+    with open(output_file) as file:
+        assert file.read() == "previous\n"
+    assert not os.path.exists(output_file + ".tmp")
+    assert not os.path.exists(parquet_sibling(output_file))
+    assert not os.path.exists(parquet_sibling(output_file) + ".tmp")
+
+
+def test_apply_dtypes_warns_when_a_column_does_not_fit():
+    df = pd.DataFrame({"party_size_flight": ["1", "two"], "unique_id": ["1", "2"]})
+
+    with pytest.warns(UserWarning, match="party_size_flight"):
+        apply_dtypes(df, {"party_size_flight": "Int64", "unique_id": "Int64"})
+
+    assert df["party_size_flight"].tolist() == ["1", "two"]
+    assert str(df["unique_id"].dtype) == "Int64"
+
+
+def test_attach_weights_warns_about_weights_of_unknown_records():
+    df = pd.DataFrame({"unique_id": [1, 2, 3], "weight": 1.0})
+    weights_df = pd.DataFrame({"unique_id": [3, 1, 9], "weight": [30.0, 10.0, 90.0]})
+
+    with pytest.warns(UserWarning, match="1 unique_id values"):
+        weighted_df = attach_weights(df, {"weight_departing_only": weights_df})
+
+    assert list(weighted_df.columns) == ["unique_id", "weight_departing_only"]
+    np.testing.assert_array_equal(weighted_df["weight_departing_only"], [10.0, np.nan, 30.0])
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from expansion import SurveyExpansion
+
+
+def make_expansion(controls: dict, expressions: dict, priority: dict) -> SurveyExpansion:
+    survey_df = pd.DataFrame({
+        "unique_id": np.arange(1, 9),
+        "marketsegment": 1,
+        "airport_terminal": ["1", "1", "1", "1", "2", "2", "2", "2"],
+        "party_size_flight": [1, 2, 1, 3, 2, 1, 1, 2],
+        "count": 1,
+    })
+    controls_df = pd.DataFrame({"airport_terminal": ["1", "2"], **controls})
+    config_df = pd.DataFrame({
+        "controlid": list(expressions),
+        "expression": list(expressions.values()),
+        "priority": [priority[control] for control in expressions],
+        "indexkey": "airport_terminal",
+        "controlkey": "airport_terminal",
+    })
+    return SurveyExpansion(survey_df, controls_df, config_df)
+
+
+@pytest.mark.parametrize("method", ["sequential", "simultaneous"])
+def test_control_without_incident_records_does_not_block_convergence(method):
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0], "stopovers": [5.0, 5.0]},
+        {"total_pax": "count", "stopovers": "ifelse(party_size_flight > 5, 1, 0)"},
+        {"total_pax": 1000, "stopovers": 1000},
+    )
+
+    assert not expansion.fitted[:, 1].any()
+    _, _, _, convergence_df = expansion.run(max_iteration=50, control_tolerance=1e-6, method=method)
+    assert convergence_df["converged"].iloc[-1]
+
+
+def test_control_gap_is_measured_to_the_relaxed_targets():
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0], "travelers": [100.0, 100.0]},
+        {"total_pax": "count", "travelers": "party_size_flight"},
+        {"total_pax": 1000, "travelers": 1},
+    )
+
+    weight, rfac, _, convergence_df = expansion.run(max_iteration=50, control_tolerance=1e-6, method="simultaneous")
+
+    # the low priority travelers control gives up part of its target to meet the passengers
+    assert convergence_df["converged"].iloc[-1]
+    assert expansion.control_gap(weight, rfac) <= 1e-6
+    assert expansion.control_gap(weight) > 0.1
+    sums = expansion.control_sums(weight)
+    np.testing.assert_allclose(sums, expansion.targets * rfac, rtol=1e-6)
+
+
+def test_simultaneous_step_that_does_not_reduce_the_gaps_is_rejected(monkeypatch):
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0], "travelers": [70.0, 90.0]},
+        {"total_pax": "count", "travelers": "party_size_flight"},
+        {"total_pax": 1000, "travelers": 1000},
+    )
+    # a Newton step in the wrong direction, which no step size makes better
+    solve = np.linalg.solve
+    monkeypatch.setattr(np.linalg, "solve", lambda a, b: -solve(a, b))
+
+    weight, rfac = expansion.initial_weight.copy(), np.ones_like(expansion.targets)
+    gap = expansion.control_gap(weight, rfac)
+    correction = expansion.fit_all_controls(weight, rfac)
+
+    assert expansion.control_gap(weight, rfac) < gap
+    expected_weight, expected_rfac = expansion.initial_weight.copy(), np.ones_like(expansion.targets)
+    expected_correction = np.column_stack([
+        expansion.fit_control(j, expected_weight, expected_rfac) for j in range(len(expansion.controls))
+    ])
+    np.testing.assert_allclose(weight, expected_weight)
+    np.testing.assert_allclose(rfac, expected_rfac)
+    np.testing.assert_allclose(correction, expected_correction)
+
+
+def test_seed_rfac_starts_missing_controls_from_one():
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0], "travelers": [70.0, 90.0]},
+        {"total_pax": "count", "travelers": "party_size_flight"},
+        {"total_pax": 1000, "travelers": 1},
+    )
+    rfac_df = pd.DataFrame({"airport_terminal": ["2", "1"], "R_travelers": [0.5, 0.8]})
+
+    with pytest.warns(UserWarning, match="total_pax"):
+        rfac = expansion.seed_rfac(rfac_df)
+
+    np.testing.assert_allclose(rfac, [[1.0, 0.8], [1.0, 0.5]])
+
+
+def test_seed_rfac_without_control_keys_starts_from_one():
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0]},
+        {"total_pax": "count"},
+        {"total_pax": 1000},
+    )
+    # as written by the R notebook
+    rfac_df = pd.DataFrame({"all": [1], "total_pax": [0.9]})
+
+    with pytest.warns(UserWarning, match="airport_terminal"):
+        rfac = expansion.seed_rfac(rfac_df)
+
+    np.testing.assert_allclose(rfac, np.ones((2, 1)))
+
+
+def test_simultaneous_run_ignores_initial_weights_with_a_warning():
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0], "travelers": [70.0, 90.0]},
+        {"total_pax": "count", "travelers": "party_size_flight"},
+        {"total_pax": 1000, "travelers": 1},
+    )
+    expected = expansion.run(5, method="simultaneous")[0]
+
+    with pytest.warns(UserWarning, match="initial weights are ignored"):
+        weight = expansion.run(5, method="simultaneous", initial_weight=expected * 2)[0]
+
+    np.testing.assert_allclose(weight, expected)
+
+
+def test_seed_weights_warns_about_records_without_weights():
+    expansion = make_expansion(
+        {"total_pax": [40.0, 60.0]},
+        {"total_pax": "count"},
+        {"total_pax": 1000},
+    )
+    weights_df = pd.DataFrame({"unique_id": [2, 1], "weight": [6.0, 5.0]})
+
+    with pytest.warns(UserWarning, match="6 of 8 records"):
+        weight = expansion.seed_weights(weights_df)
+
+    np.testing.assert_allclose(weight[:2], [5.0, 6.0])
+    np.testing.assert_allclose(weight[2:], expansion.initial_weight[2:])
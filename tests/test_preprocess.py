@@ -0,0 +1,47 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from preprocess import Recode, RecodeMap, apply_recodes, read_excel_cached
+
+
+def test_read_excel_cached_returns_the_same_frame_before_and_after_caching(tmp_path):
+    workbook = tmp_path / "delivery.xlsx"
+    pd.DataFrame({
+        "respondentid": [1, 2, 3],
+        "main_mode": [1, "-oth-", 3],
+        "date_completed": [datetime.datetime(2024, 11, 1), "unknown", None],
+    }).to_excel(workbook, index=False)
+
+    first = read_excel_cached(str(workbook), cache_dir=str(tmp_path / "cache"))
+    second = read_excel_cached(str(workbook), cache_dir=str(tmp_path / "cache"))
+
+    pd.testing.assert_frame_equal(first, second)
+    assert first["main_mode"].tolist() == [1, "-oth-", 3]
+
+
+def test_apply_recodes_raises_on_a_missing_column_before_changing_the_data():
+    recode_maps = {"inbound_or_outbound": RecodeMap("inbound_or_outbound", ["IN", "OUT"], [1, 2])}
+    df = pd.DataFrame({"inbound_or_outbound": ["IN", "OUT"]})
+
+    with pytest.raises(ValueError, match="interview_location"):
+        apply_recodes(
+            df,
+            [Recode("inbound_or_outbound", "inbound_or_outbound", "inbound_or_outbound"),
+             Recode("interview_location", "interview_location", "inbound_or_outbound")],
+            recode_maps,
+        )
+    assert df["inbound_or_outbound"].tolist() == ["IN", "OUT"]
+
+
+def test_apply_recodes_warns_about_unmapped_values():
+    recode_maps = {"inbound_or_outbound": RecodeMap("inbound_or_outbound", ["IN", "OUT"], [1, 2])}
+    df = pd.DataFrame({"inbound_or_outbound": ["IN", "OUT", "BOTH", "BOTH"]})
+
+    with pytest.warns(UserWarning, match="2 records with 1 values"):
+        df, unmapped_df = apply_recodes(
+            df, [Recode("inbound_or_outbound", "inbound_or_outbound", "inbound_or_outbound")], recode_maps
+        )
+    assert df["inbound_or_outbound"].tolist()[:2] == [1, 2]
+    assert unmapped_df["value"].tolist() == ["BOTH"]
@@ -0,0 +1,47 @@
+import pandas as pd
+
+import enums as e
+from utils import SyntheticRecordSpec, departing_to_arriving_spec, write_synthetic_records
+
+
+def test_write_synthetic_records_keeps_the_formatting_of_the_input(tmp_path):
+    input_csv = tmp_path / "survey.csv"
+    input_csv.write_text(
+        "respondentid,inbound_or_outbound,origin,destination,weight,comment\n"
+        "1,2,10,20,2.0,\"late, rebooked\"\n"
+        "2,1,11,21,,\n"
+        "3,2,12,22,1.5,\n"
+        "4,2,13,,3.0,NA\n"
+    )
+    spec = SyntheticRecordSpec(
+        source_filter={"inbound_or_outbound": 2},
+        set_values={"inbound_or_outbound": 1},
+        swap_pairs=[("origin", "destination")],
+    )
+    output_csv = tmp_path / "combined.csv"
+
+    num_synthetic = write_synthetic_records(str(input_csv), str(output_csv), chunksize=2, spec=spec)
+
+    assert num_synthetic == 3
+    assert output_csv.read_text() == input_csv.read_text() + (
+        "syn-1,1,20,10,2.0,\"late, rebooked\"\n"
+        "syn-3,1,22,12,1.5,\n"
+        "syn-4,1,,13,3.0,NA\n"
+    )
+    assert len(pd.read_csv(output_csv)) == 7
+
+
+def test_departing_to_arriving_spec_makes_unknown_directions_inbound():
+    spec = departing_to_arriving_spec()
+    df = pd.DataFrame({col: [None] * 4 for col in spec.columns()}).assign(
+        respondentid=[1, 2, 3, 4],
+        passenger_type=e.PassengerType.DEPARTING,
+        initial_etc_check=True,
+        inbound_or_outbound=[1, 2, None, 99],
+    )
+
+    synthetic_df = spec.build_records(df.loc[spec.select_sources(df)])
+
+    assert synthetic_df["inbound_or_outbound"].tolist() == [2, 1, 1, 1]
+    reversed_df = spec.reversed().build_records(df)
+    assert reversed_df["inbound_or_outbound"].tolist() == [2, 1, 2, 2]